@@ -30,10 +30,60 @@ export type HistoryLine = {
   line: string,
 };
 
+const atlases: Record<string, Promise<HTMLImageElement | null>> = {};
+
+/**
+ * Object URLs of the sprites cut out of atlases, revoked when another story is loaded.
+ */
+let spriteObjectUrls: string[] = [];
+
+function fetchAtlas(url: string) {
+  if (!(url in atlases)) {
+    atlases[url] = new Promise((resolve) => {
+      const image = new Image();
+      // atlases from other origins would otherwise taint the canvas the sprites are cut out with
+      image.crossOrigin = 'anonymous';
+      image.onload = () => resolve(image);
+      image.onerror = () => resolve(null);
+      image.src = url;
+    });
+  }
+  return atlases[url];
+}
+
+/**
+ * Cuts the sprite out of its atlas, falling back to the standalone image.
+ */
+async function resolveSpriteUrl(s: CharacterSprite) {
+  if (!s.atlas || !s.rect) {
+    return s.url;
+  }
+  const atlas = await fetchAtlas(s.atlas);
+  if (!atlas) {
+    return s.url;
+  }
+  const [x, y, width, height] = s.rect;
+  const canvas = document.createElement('canvas');
+  canvas.width = width;
+  canvas.height = height;
+  canvas.getContext('2d')?.drawImage(atlas, x, y, width, height, 0, 0, width, height);
+  const blob = await new Promise<Blob | null>((resolve) => { canvas.toBlob(resolve); });
+  if (!blob) {
+    return s.url;
+  }
+  const url = URL.createObjectURL(blob);
+  spriteObjectUrls.push(url);
+  return url;
+}
+
+function revokeSpriteUrls() {
+  spriteObjectUrls.forEach((url) => URL.revokeObjectURL(url));
+  spriteObjectUrls = [];
+}
+
 function fetchSpriteImage(character: string, s: CharacterSprite) {
   const image = new Image();
   return new Promise<[string, SpriteImage]>((resolve) => {
-    image.src = s.url;
     const sprite = s as SpriteImage;
     sprite.image = image;
     const result = [`${character}/${s.name}`, sprite] as [string, SpriteImage];
@@ -44,6 +94,9 @@ function fetchSpriteImage(character: string, s: CharacterSprite) {
       }
       resolve(result);
     };
+    resolveSpriteUrl(s)
+      .catch(() => s.url)
+      .then((url) => { image.src = url; });
   });
 }
 
@@ -92,6 +145,8 @@ export class StoryInterpreter {
 
   async preloadResources() {
     this.preloadedImages = {};
+    // the sprites of the previous story are no longer displayed
+    revokeSpriteUrls();
     const images = this.characters.flatMap((c) => c.sprites.map(
       (s) => fetchSpriteImage(c.name, s),
     ));
@@ -12,6 +12,7 @@ export interface GfSpriteInfo {
   path: string;
   scale: number;
   offset: readonly [number, number];
+  center?: readonly [number, number];
 }
 
 export type GfCharacterInfo = {
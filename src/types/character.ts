@@ -19,6 +19,14 @@ export interface CharacterSprite {
    * The id.
    */
   id: string;
+  /**
+   * The atlas holding the image, if packed by `gfunpack --atlas`.
+   */
+  atlas?: string;
+  /**
+   * The `[x, y, width, height]` of the image in the atlas.
+   */
+  rect?: readonly [number, number, number, number];
 }
 
 export interface Character {
@@ -1,36 +1,231 @@
 import argparse
 import os
 import pathlib
+import typing
 
-from gfunpack import audio, backgrounds, chapters, characters, mapper, prefabs, stories
+# stage modules pull in UnityPy, PIL, tqdm and hjson, so they are only imported by the stages that run
+from gfunpack import checkpoint, governor, imaging, manifest, profiles, scratch, shards, tools, trace
+
+if typing.TYPE_CHECKING:
+    from gfunpack import cache, stories
+
+stage_names = ('backgrounds', 'characters', 'audio', 'stories', 'chapters')
+
+
+def _quality(spec: str):
+    """
+    Parses `CATEGORY=QUALITY` for `--quality`.
+    """
+    category, _, quality = spec.partition('=')
+    if category not in imaging.categories:
+        raise argparse.ArgumentTypeError(f'unknown image category {category!r}, expected one of {", ".join(imaging.categories)}')
+    if not quality.isdigit() or not 0 <= int(quality) <= 100:
+        raise argparse.ArgumentTypeError(f'invalid quality {quality!r} for {category}, expected 0 to 100')
+    return category, int(quality)
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument('dir')
 parser.add_argument('-o', '--output', required=True)
 parser.add_argument('--no-clean', action='store_true')
-args = parser.parse_args()
+parser.add_argument('--referenced-only', action='store_true',
+                    help='only extract backgrounds, sprites and audio used by the stories')
+parser.add_argument('--profile', choices=list(profiles.profiles), default=profiles.default_profile,
+                    help='encoder settings (effort, pngquant, image format, audio), '
+                    'outputs of another profile are encoded again')
+parser.add_argument('--image-format', choices=imaging.image_formats,
+                    help='publish images in this format instead of the one of the profile (png files are kept as fallbacks)')
+parser.add_argument('--quality', type=_quality, action='append', default=[], metavar='CATEGORY=QUALITY',
+                    help=f'encoder quality per image category ({", ".join(imaging.categories)})')
+parser.add_argument('--variants', type=int, nargs='*', default=[], metavar='PERCENT',
+                    help='also emit downscaled image variants, e.g. --variants 50 25')
+parser.add_argument('--trim', action='store_true',
+                    help='crop transparent borders off sprites (crop boxes are recorded in characters.json)')
+parser.add_argument('--atlas', type=int, nargs='?', const=4096, metavar='SIZE',
+                    help='pack the sprites of each character into atlases of at most SIZE pixels square '
+                    '(the viewer cuts sprites out of them, standalone images are kept as fallbacks)')
+parser.add_argument('--texture-cache', metavar='DIR',
+                    help='keep decoded textures in this directory for later runs')
+parser.add_argument('--texture-cache-size', type=int, default=8192, metavar='MIB',
+                    help='disk budget of the texture cache, least recently used textures are evicted first')
+parser.add_argument('--bundle-cache', metavar='DIR',
+                    help='keep decompressed copies of compressed bundles in this directory for later stages and runs')
+parser.add_argument('--bundle-cache-size', type=int, default=16384, metavar='MIB',
+                    help='disk budget of the bundle cache, least recently used bundles are evicted first')
+parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                    help='cpu slots shared by all stages and the tools they spawn (defaults to the core count)')
+parser.add_argument('--io-jobs', type=int, default=4, metavar='N', help='concurrent bundle loads')
+parser.add_argument('--tool-timeout', type=float, metavar='SECONDS',
+                    help='kill external tools (ffmpeg, magick, pngquant, vgmstream-cli) running longer than this')
+parser.add_argument('--scratch', metavar='DIR',
+                    help='directory for intermediate files (defaults to /dev/shm when available)')
+parser.add_argument('--scratch-size', type=int, metavar='MIB',
+                    help='byte budget of the scratch area (defaults to half of its free space)')
+parser.add_argument('--resume', action='store_true',
+                    help='continue an interrupted run, skipping stages, bundles and items it already finished')
+parser.add_argument('--only', nargs='+', choices=stage_names, metavar='STAGE',
+                    help=f'only run these stages ({", ".join(stage_names)}), '
+                    'the others are loaded from the indexes of an earlier run')
+parser.add_argument('--skip', nargs='+', choices=stage_names, default=[], metavar='STAGE',
+                    help='skip these stages, loading their results from the indexes of an earlier run')
+parser.add_argument('--shard', type=shards.Shard.parse, metavar='I/N',
+                    help='only process shard I of N (counting from 0), to be combined by `python -m gfunpack.merge`')
+parser.add_argument('--hashed', action='store_true',
+                    help='emit content-hashed copies of images and audio and index them through manifest.json')
+parser.add_argument('--delta', action='store_true',
+                    help='index published files into publish.json and list changes since the last run in delta.json')
+parser.add_argument('--previous', help='publish.json of the previous run (defaults to the one in the output directory)')
+parser.add_argument('--verify', action='store_true', help='walk the image tree to report unmapped sprites')
+parser.add_argument('--trace', help='write a Trace Event Format timeline (chrome://tracing, Perfetto) to this file')
+
+
+def main(argv: list[str] | None = None):
+    args = parser.parse_args(argv)
+
+    cpus = args.jobs or os.cpu_count() or 2
+    governor.configure(cpus, args.io_jobs)
+    tools.configure(timeout=args.tool_timeout)
+    scratch.configure(args.scratch, None if args.scratch_size is None else args.scratch_size * 1024 * 1024)
+
+    downloaded = args.dir
+    destination = pathlib.Path(args.output)
+
+    if args.trace:
+        trace.enable(args.trace)
+
+    requested = set(args.only or stage_names) - set(args.skip)
+    destination.mkdir(parents=True, exist_ok=True)
+    progress = checkpoint.Checkpoint(destination.joinpath('.checkpoint.json'), resume=args.resume, stages=requested)
+    # stages that finished before an interruption are loaded from their indexes, like skipped ones
+    selected = requested - progress.finished if args.resume else requested
+    hashed = manifest.Manifest(destination) if args.hashed else None
+    if hashed is not None and selected != set(stage_names):
+        hashed.load()
+    if args.bundle_cache:
+        from gfunpack import cache, utils
+        utils.use_bundle_cache(cache.BundleCache(args.bundle_cache, args.bundle_cache_size * 1024 * 1024))
+    texture_cache: 'cache.TextureCache | None' = None
+    if args.texture_cache:
+        from gfunpack import cache
+        texture_cache = cache.TextureCache(args.texture_cache, args.texture_cache_size * 1024 * 1024)
+    shard: shards.Shard | None = args.shard
+    if shard is not None:
+        shard.save(destination)
+    profile = profiles.profiles[args.profile]
+    stamps = profiles.Stamps(destination)
+    image_output = imaging.ImageOutput(
+        args.image_format or profile.image_format,
+        dict(args.quality),
+        tuple(args.variants),
+        profile.effort,
+    )
+
+    try:
+        references = None
+        if (args.referenced_only or image_output.format != 'png') and not selected.isdisjoint(('backgrounds', 'characters', 'audio')):
+            # also tells CGs apart from other backgrounds for the quality presets
+            from gfunpack import stories
+            with trace.span('references', 'stage'):
+                references = stories.collect_references(downloaded, str(destination.joinpath('gf-data-ch')))
 
-cpus = os.cpu_count() or 2
+        images = destination.joinpath('images')
+        if 'backgrounds' in selected:
+            from gfunpack import backgrounds
+            with trace.span('backgrounds', 'stage'):
+                bg = backgrounds.BackgroundCollection(
+                    downloaded, str(images), pngquant=profile.pngquant, force=stamps.outdated('backgrounds', profile),
+                    concurrency=cpus,
+                    referenced=None if references is None or not args.referenced_only else references.backgrounds | references.cgs,
+                    cgs=None if references is None else references.cgs,
+                    output=image_output, texture_cache=texture_cache, checkpoint=progress, shard=shard,
+                )
+                bg.extract()
+                bg.save(hashed)
+                stamps.stamp('backgrounds', profile)
+                progress.finish('backgrounds')
 
-downloaded = args.dir
-destination = pathlib.Path(args.output)
+        if 'characters' in selected:
+            from gfunpack import characters, mapper, prefabs
+            with trace.span('prefabs', 'stage'):
+                sprite_indices = prefabs.Prefabs(downloaded, cache=str(destination.joinpath('prefabs.cache.json')))
+                sprite_indices.extract()
+            with trace.span('characters', 'stage'):
+                chars = characters.CharacterCollection(
+                    downloaded, str(images), sprite_indices, pngquant=profile.pngquant,
+                    force=stamps.outdated('characters', profile), concurrency=cpus,
+                    referenced=None if references is None or not args.referenced_only else references.sprites,
+                    output=image_output, trim=args.trim, atlas_size=args.atlas,
+                    texture_cache=texture_cache, checkpoint=progress, shard=shard,
+                )
+                chars.extract()
+                stamps.stamp('characters', profile)
 
-images = destination.joinpath('images')
-bg = backgrounds.BackgroundCollection(downloaded, str(images), pngquant=True, concurrency=cpus)
-bg.save()
+            with trace.span('mapper', 'stage'):
+                character_mapper = mapper.Mapper(sprite_indices, chars, verify=args.verify)
+                character_mapper.map_sprite_path_ids()
+                character_mapper.write_indices(hashed)
+            # characters.json is only written by the mapper
+            progress.finish('characters')
 
-sprite_indices = prefabs.Prefabs(downloaded)
-chars = characters.CharacterCollection(downloaded, str(images), sprite_indices, pngquant=True, concurrency=cpus)
-chars.extract()
+        if 'audio' in selected:
+            from gfunpack import audio
+            with trace.span('audio', 'stage'):
+                bgm = audio.BGM(
+                    downloaded, str(destination.joinpath('audio')), force=stamps.outdated('audio', profile),
+                    concurrency=cpus, clean=not args.no_clean,
+                    referenced=None if references is None or not args.referenced_only else references.audio,
+                    checkpoint=progress, shard=shard, encoder=profile.audio,
+                )
+                bgm.extract()
+                bgm.save(hashed)
+                stamps.stamp('audio', profile)
+                progress.finish('audio')
 
-character_mapper = mapper.Mapper(sprite_indices, chars)
-character_mapper.write_indices()
+        # later stages only see the earlier ones through their indexes (audio.json, backgrounds.json, characters.json)
+        story_directory = destination.joinpath('stories')
+        ss: 'stories.Stories | None' = None
+        if 'stories' in selected:
+            from gfunpack import stories
+            with trace.span('stories', 'stage'):
+                ss = stories.Stories(
+                    downloaded, str(story_directory),
+                    gf_data_directory=str(destination.joinpath('gf-data-ch')),
+                    # shards only hold part of the resources, their scripts are linked by the merge step
+                    shard=shard, raw=shard is not None,
+                )
+                ss.extract()
+                ss.save()
+                progress.finish('stories')
+        if 'chapters' in selected and shard is None:
+            from gfunpack import chapters, stories
+            # chapters need all stories, for shards they are left to the merge step
+            with trace.span('chapters', 'stage'):
+                if ss is None:
+                    ss = stories.Stories.load(str(story_directory), str(destination.joinpath('gf-data-ch')))
+                cs = chapters.Chapters(ss)
+                cs.categorize()
+                cs.save()
+                progress.finish('chapters')
+        if hashed is not None:
+            hashed.save()
+        if args.delta:
+            with trace.span('delta', 'stage'):
+                manifest.write_delta(destination, args.previous)
+        if requested == set(stage_names):
+            progress.clear()
+        else:
+            # the entries of the stages that did not run were loaded from the file and are written back
+            progress.save()
+    except BaseException:
+        # kill the external tools still running instead of leaving them behind
+        tools.get().cancel()
+        progress.save()
+        raise
+    finally:
+        tools.get().summary()
+        scratch.close()
+        trace.save()
 
-bgm = audio.BGM(downloaded, str(destination.joinpath('audio')), concurrency=cpus, clean=not args.no_clean)
-bgm.save()
 
-ss = stories.Stories(downloaded, str(destination.joinpath('stories')))
-ss.save()
-cs = chapters.Chapters(ss)
-cs.save()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import json
+import logging
+import pathlib
+
+from PIL import Image
+
+from gfunpack import imaging, trace, utils
+
+_logger = logging.getLogger('gfunpack.atlas')
+_warning = _logger.warning
+
+atlas_prefix = '_atlas-'
+
+Rect = tuple[int, int, int, int]
+"""`(x, y, width, height)` in pixels of the atlas."""
+
+
+def is_atlas(path: pathlib.Path):
+    return path.name.startswith(atlas_prefix)
+
+
+def pack(sizes: list[tuple[int, int]], max_size: int = 4096, padding: int = 2):
+    """
+    Packs rectangles into as few `max_size` squares as a shelf packer manages.
+
+    Rectangles are placed tallest first, left to right on shelves as high as their first rectangle.
+    Returns `(atlas index, rect)` for each size in order, or `None` for ones larger than `max_size`.
+    """
+    placed: list[tuple[int, Rect] | None] = [None] * len(sizes)
+    order = sorted(range(len(sizes)), key=lambda i: (sizes[i][1], sizes[i][0]), reverse=True)
+    atlas = 0
+    x = y = shelf_height = 0
+    for i in order:
+        width, height = sizes[i]
+        if width > max_size or height > max_size:
+            continue
+        if x + width > max_size:
+            x, y, shelf_height = 0, y + shelf_height + padding, 0
+        if y + height > max_size:
+            atlas, x, y, shelf_height = atlas + 1, 0, 0, 0
+        placed[i] = (atlas, (x, y, width, height))
+        x += width + padding
+        shelf_height = max(shelf_height, height)
+    return placed
+
+
+class CharacterAtlas:
+    """
+    Sprites of a character packed into `_atlas-<n>.png` files inside its image directory.
+
+    Member fingerprints are kept in `.atlas.json` so that atlases are only rebuilt when a member changes.
+    """
+
+    directory: pathlib.Path
+
+    rects: dict[pathlib.Path, tuple[pathlib.Path, Rect]]
+    """Atlas PNG and rectangle of each packed member."""
+
+    max_size: int
+
+    def __init__(self, directory: pathlib.Path, max_size: int = 4096) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.rects = {}
+
+    def _index_path(self):
+        return self.directory.joinpath('.atlas.json')
+
+    def _read_index(self) -> dict:
+        path = self._index_path()
+        if not path.is_file():
+            return {}
+        with path.open() as f:
+            return json.load(f)
+
+    def _load(self, index: dict):
+        self.rects = dict(
+            (self.directory.joinpath(name), (self.directory.joinpath(atlas), tuple(rect)))
+            for name, (atlas, rect) in index['rects'].items()
+        )
+
+    def build(self, members: list[pathlib.Path], output: imaging.ImageOutput, use_pngquant: bool = False):
+        members = sorted(set(members))
+        fingerprints = dict((member.name, utils.fingerprint(member)) for member in members)
+        index = self._read_index()
+        atlases = [self.directory.joinpath(name) for name in index.get('atlases', [])]
+        if (
+            index.get('members') == fingerprints and index.get('max_size') == self.max_size
+            and all(output.is_complete(atlas) for atlas in atlases)
+        ):
+            self._load(index)
+            return False
+
+        images = [Image.open(member) for member in members]
+        try:
+            placed = pack([image.size for image in images], self.max_size)
+            count = max((p[0] + 1 for p in placed if p is not None), default=0)
+            extents = [(0, 0)] * count
+            for p in placed:
+                if p is not None:
+                    i, (x, y, width, height) = p
+                    extents[i] = (max(extents[i][0], x + width), max(extents[i][1], y + height))
+            canvases = [Image.new('RGBA', extent, (0, 0, 0, 0)) for extent in extents]
+            rects: dict[str, tuple[str, Rect]] = {}
+            for member, image, p in zip(members, images, placed):
+                if p is None:
+                    _warning('%s too large for an atlas', member)
+                    continue
+                i, rect = p
+                canvases[i].paste(image.convert('RGBA'), rect[:2])
+                rects[member.name] = (f'{atlas_prefix}{i}.png', rect)
+        finally:
+            for image in images:
+                image.close()
+
+        names = [f'{atlas_prefix}{i}.png' for i in range(count)]
+        for name, canvas in zip(names, canvases):
+            atlas = self.directory.joinpath(name)
+            with trace.span(name, 'atlas', directory=self.directory.name):
+                tmp = atlas.with_name(f'.{name}.tmp')
+                output.save_png(canvas, tmp)
+                tmp.replace(atlas)
+                output.encode(atlas, 'sprite', canvas, force=True)
+                utils.pngquant(atlas, use_pngquant=use_pngquant, stage='characters')
+        for stale in atlases:
+            if stale.name not in names:
+                for path in [stale, output.path(stale), *output.variant_paths(stale).values()]:
+                    path.unlink(missing_ok=True)
+        index = {
+            'max_size': self.max_size,
+            'members': fingerprints,
+            'atlases': names,
+            'rects': rects,
+        }
+        with self._index_path().open('w') as f:
+            f.write(json.dumps(index, indent=2, ensure_ascii=False))
+        self._load(index)
+        return True
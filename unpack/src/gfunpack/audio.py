@@ -1,19 +1,24 @@
+import concurrent.futures
 import json
 import logging
 import pathlib
 import shutil
 import subprocess
 import threading
+import typing
 import zipfile
 
 import tqdm
 
-from gfunpack import utils
+from gfunpack import checkpoint, manifest, scratch, shards, tools, trace, utils
 
 _logger = logging.getLogger('gfunpack.utils')
 _info = _logger.info
 _warning = _logger.warning
 
+_wav_ratio = 12
+"""Rough size of decoded wav files relative to the compressed archives, for scratch space reservations."""
+
 
 def _test_vgmstream():
     try:
@@ -25,7 +30,7 @@ def _test_vgmstream():
         raise FileNotFoundError('vgmstream-cli is required to unpack sound files')
 
 
-def _extract_zip(path: pathlib.Path, directory: pathlib.Path, force: bool = False):
+def _extract_zip(path: pathlib.Path, directory: pathlib.Path, destination: pathlib.Path, force: bool = False):
     with zipfile.ZipFile(path) as z:
         extracted: list[pathlib.Path] = []
         for file in z.filelist:
@@ -34,7 +39,7 @@ def _extract_zip(path: pathlib.Path, directory: pathlib.Path, force: bool = Fals
                     output.is_file() # *.acb.bytes
                     or output.with_suffix('').is_file() # *.acb
                     or output.with_suffix('').with_suffix('.wav').is_file() # *.wav
-                    or output.with_suffix('').with_suffix('.m4a').is_file() # *.m4a
+                    or destination.joinpath(file.filename).with_suffix('').with_suffix('.m4a').is_file() # *.m4a
             ):
                 z.extract(file, directory)
                 extracted.append(output)
@@ -51,31 +56,56 @@ def _test_ffmpeg():
         raise FileNotFoundError('ffmpeg is required to transcode audio files')
 
 
-def _transcode_files(files: list[pathlib.Path], force: bool, concurrency: int, clean: bool,
-                     batch_size: int = -1, bar: tqdm.tqdm | None = None):
-    semaphore = threading.Semaphore(concurrency)
-    def transcode(file: pathlib.Path, output: pathlib.Path):
-        nonlocal clean, force, semaphore
+def _batches(files: list[pathlib.Path], count: int, budget: int):
+    """
+    Splits `files` into batches of at most `count` archives whose decoded wav files fit in `budget` bytes.
+
+    Yields each batch with its estimated size. Archives too large for the budget on their own get a batch of their own.
+    """
+    batch: list[pathlib.Path] = []
+    size = 0
+    for file in files:
+        estimate = file.stat().st_size * _wav_ratio
+        if len(batch) > 0 and (len(batch) >= count or size + estimate > budget):
+            yield batch, size
+            batch, size = [], 0
+        batch.append(file)
+        size += estimate
+    if len(batch) > 0:
+        yield batch, size
+
+
+def _transcode_files(files: list[pathlib.Path], destination: pathlib.Path, force: bool, clean: bool,
+                     batch_size: int = -1, bar: tqdm.tqdm | None = None, encoder: typing.Sequence[str] = ()):
+    # all transcoding jobs are handed to the tool runner at once, which bounds the processes in flight
+    pending: list[tuple[pathlib.Path, pathlib.Path, concurrent.futures.Future | None]] = []
+    converted: dict[str, pathlib.Path] = {}
+    for file in files:
+        output = destination.joinpath(f'{file.stem}.m4a')
+        encoded = scratch.get().path(output.name)
+        future = None
         if force or not output.is_file():
-            subprocess.run([
+            future = tools.submit([
                 'ffmpeg',
                 '-hide_banner',
                 '-loglevel',
                 'error',
                 '-i',
                 file,
-                output,
-            ]).check_returncode()
+                '-threads',
+                tools.THREADS,
+                *encoder,
+                encoded,
+            ], 'audio')
+        pending.append((file, encoded, future))
+        converted[file.stem] = output
+
+    for file, encoded, future in pending:
+        if future is not None:
+            future.result().check_returncode()
+            scratch.commit(encoded, destination.joinpath(f'{file.stem}.m4a'))
         if clean:
             file.unlink()
-        semaphore.release()
-
-    converted: dict[str, pathlib.Path] = {}
-    for file in files:
-        semaphore.acquire()
-        output = file.with_suffix('.m4a')
-        threading.Thread(target=transcode, args=(file, output)).start()
-        converted[file.stem] = output
         if bar:
             if batch_size == -1 or batch_size == len(files):
                 bar.update()
@@ -84,31 +114,28 @@ def _transcode_files(files: list[pathlib.Path], force: bool, concurrency: int, c
 
     if bar and batch_size != -1 and batch_size != len(files):
         bar.update(batch_size)
-
-    for _ in range(concurrency):
-        semaphore.acquire()
     return converted
 
 
-def _extract_acb_to_wav(dat: pathlib.Path, destination: pathlib.Path,
+def _extract_acb_to_wav(dat: pathlib.Path, directory: pathlib.Path, destination: pathlib.Path,
                         semaphore: threading.Semaphore | None = None,
                         force: bool = False,
                         clean: bool = True):
     try:
-        acb_audios = _extract_zip(dat, destination, force=force)
+        acb_audios = _extract_zip(dat, directory, destination, force=force)
         assert len(acb_audios) <= 1
         if len(acb_audios) == 1:
             acb = acb_audios[0]
             assert acb.suffix == '.bytes'
             acb = acb.rename(acb.with_suffix(''))
-            subprocess.run([
+            tools.run([
                 'vgmstream-cli',
                 acb,
                 '-o',
-                destination.joinpath('?n.wav'),
+                directory.joinpath('?n.wav'),
                 '-S',
                 '0',
-            ], stdout=subprocess.DEVNULL).check_returncode()
+            ], 'audio', stdout=subprocess.DEVNULL).check_returncode()
             if clean:
                 acb.unlink()
         else:
@@ -138,34 +165,62 @@ class BGM:
 
     clean: bool
 
+    referenced: set[str] | None
+    """Audio identifiers to transcode, or `None` to transcode everything."""
+
+    checkpoint: checkpoint.Checkpoint | None
+    """Sound archives already transcoded by an interrupted run."""
+
+    shard: shards.Shard | None
+    """Only transcode the sound archives of this shard, or `None` to transcode all of them."""
+
+    encoder: tuple[str, ...]
+    """ffmpeg options for encoding the m4a files."""
+
     def __init__(self, directory: str, destination: str,
-                 force: bool = False, concurrency: int = 8, clean: bool = True) -> None:
+                 force: bool = False, concurrency: int = 8, clean: bool = True,
+                 referenced: set[str] | None = None, checkpoint: checkpoint.Checkpoint | None = None,
+                 shard: shards.Shard | None = None, encoder: typing.Sequence[str] = ()) -> None:
         self.directory = utils.check_directory(directory)
         self.destination = utils.check_directory(pathlib.Path(destination).joinpath('bgm'), create=True)
         self.se_destination = utils.check_directory(pathlib.Path(destination).joinpath('se'), create=True)
         self.force = force
         self.concurrency = concurrency
         self.clean = clean
-        self.resource_files = list(f for f in self.directory.glob('*.acb.dat') if f.name != 'AVG.acb.dat')
+        self.referenced = referenced
+        self.checkpoint = checkpoint
+        self.shard = shard
+        self.encoder = tuple(encoder)
+        self.resource_files = list(
+            f for f in self.directory.glob('*.acb.dat')
+            if f.name != 'AVG.acb.dat' and (shard is None or shard.owns(f.name))
+        )
         self.se_resource_file = self.directory.joinpath('AVG.acb.dat')
+        self.extracted = {}
+
+    def extract(self):
         _test_ffmpeg()
         self.extracted = self.extract_and_convert()
+        return self.extracted
 
-    def extract_all(self, resource_files: list[pathlib.Path]):
+    def extract_all(self, resource_files: list[pathlib.Path], directory: pathlib.Path):
         _test_vgmstream()
         semaphore = threading.Semaphore(self.concurrency)
         for file in resource_files:
-            semaphore.acquire()
+            with trace.span('semaphore', 'wait'):
+                semaphore.acquire()
             threading.Thread(
                 target=_extract_acb_to_wav,
-                args=(file, self.destination, semaphore, self.force, self.clean),
+                args=(file, directory, self.destination, semaphore, self.force, self.clean),
             ).start()
         for _ in range(self.concurrency):
             semaphore.acquire()
-        return list(self.destination.glob('*.wav'))
+        return list(directory.glob('*.wav'))
 
     def _get_audio_template(self):
-        content = utils.read_text_asset(self.directory.joinpath('asset_textes.ab'), 'assets/resources/textdata/audiotemplate.txt')
+        content = utils.read_text_asset(
+            self.directory.joinpath('asset_textes.ab'), 'assets/resources/textdata/audiotemplate.txt', 'audio',
+        )
         mapping: dict[str, str] = {}
         for line in (l.strip() for l in content.split('\n')):
             if '//' in line:
@@ -187,28 +242,71 @@ class BGM:
             mapping[name] = file
         return mapping
 
+    def _done(self, file: pathlib.Path):
+        return self.checkpoint is not None and self.checkpoint.done('audio', file.name)
+
+    def _complete(self, files: list[pathlib.Path]):
+        if self.checkpoint is not None:
+            for file in files:
+                self.checkpoint.complete('audio', file.name)
+
+    def _filter_referenced(self, files: list[pathlib.Path], name_mapping: dict[str, str]):
+        if self.referenced is None:
+            return files
+        wanted = self.referenced.union(name_mapping[name] for name in self.referenced if name in name_mapping)
+        kept: list[pathlib.Path] = []
+        for file in files:
+            if any(name.strip() in wanted for name in file.stem.split(';')):
+                kept.append(file)
+            elif self.clean:
+                file.unlink()
+        return kept
+
     def extract_and_convert(self):
+        name_mapping = self._get_audio_template()
+        # extracted .acb and .wav files go to the scratch area unless they are kept for later runs
+        area = scratch.get()
         _info('extracting se audio')
-        _extract_acb_to_wav(self.se_resource_file, self.se_destination, None, self.force, self.clean)
-        files = _transcode_files(
-            list(self.se_destination.glob('*.wav')),
-            self.force,
-            self.concurrency,
-            self.clean,
-        )
+        files: dict[str, pathlib.Path] = {}
+        if self.shard is not None and not self.shard.owns(self.se_resource_file.name):
+            _info('se audio left to other shards')
+        elif not self._done(self.se_resource_file):
+            with area.reserve(self.se_resource_file.stat().st_size * _wav_ratio) as root:
+                se_directory = area.directory('se', root) if self.clean else self.se_destination
+                _extract_acb_to_wav(self.se_resource_file, se_directory, self.se_destination, None, self.force, self.clean)
+                files = _transcode_files(
+                    self._filter_referenced(list(se_directory.glob('*.wav')), name_mapping),
+                    self.se_destination,
+                    self.force,
+                    self.clean,
+                    encoder=self.encoder,
+                )
+                if self.clean:
+                    shutil.rmtree(se_directory, ignore_errors=True)
+            self._complete([self.se_resource_file])
         _info('extracting bgm audio')
-        bar = tqdm.tqdm(total=len(self.resource_files))
-        batch_count = min(self.concurrency * 8, 32) if self.clean else len(self.resource_files)
-        for i in range(0, len(self.resource_files), batch_count):
-            batch = self.resource_files[i: i + batch_count]
-            files.update(_transcode_files(
-                self.extract_all(batch),
-                self.force,
-                self.concurrency,
-                self.clean,
-                len(batch),
-                bar,
-            ))
+        resource_files = [f for f in self.resource_files if not self._done(f)]
+        bar = tqdm.tqdm(total=len(resource_files))
+        if self.clean:
+            batches = _batches(resource_files, min(self.concurrency * 8, 32), area.budget)
+        else:
+            batches = [(resource_files, 0)] if len(resource_files) > 0 else []
+        for batch, size in batches:
+            with area.reserve(size) as root:
+                directory = area.directory('bgm', root) if self.clean else self.destination
+                files.update(_transcode_files(
+                    self._filter_referenced(self.extract_all(batch, directory), name_mapping),
+                    self.destination,
+                    self.force,
+                    self.clean,
+                    len(batch),
+                    bar,
+                    self.encoder,
+                ))
+                if self.clean:
+                    # frees the reservation for the next batch
+                    shutil.rmtree(directory, ignore_errors=True)
+            self._complete(batch)
         bar.close()
         files.update((existing.stem, existing) for existing in self.destination.glob('*.m4a'))
         files.update((existing.stem, existing) for existing in self.se_destination.glob('*.m4a'))
@@ -222,14 +320,15 @@ class BGM:
             files.pop(audio_name)
             file.unlink()
 
-        name_mapping = self._get_audio_template()
         mapping: dict[str, pathlib.Path] = {}
         for name, audio_name in name_mapping.items():
+            if self.referenced is not None and name not in self.referenced:
+                continue
             if audio_name in files:
                 mapping[name] = files[audio_name].relative_to(self.destination.parent)
             elif name in files:
                 mapping[name] = files[name].relative_to(self.destination.parent)
-            else:
+            elif self.shard is None:
                 _warning('audio identifier %s not found', name)
         mapped_files = set(mapping.values())
         for audio_name, file in files.items():
@@ -238,8 +337,15 @@ class BGM:
                 mapping[audio_name] = path
         return mapping
 
-    def save(self):
-        path = self.destination.parent.joinpath('audio.json')
+    def save(self, hashed: manifest.Manifest | None = None):
+        base = self.destination.parent
+        extracted = self.extracted
+        if hashed is not None:
+            extracted = dict(
+                (k, hashed.add(base.joinpath(v), base).relative_to(base))
+                for k, v in extracted.items()
+            )
+        path = base.joinpath('audio.json')
         with path.open('w') as f:
-            f.write(json.dumps(dict((k, str(v)) for k, v in self.extracted.items()), indent=2, ensure_ascii=False))
+            f.write(json.dumps(dict((k, str(v)) for k, v in extracted.items()), indent=2, ensure_ascii=False))
         return path
@@ -6,14 +6,15 @@ import threading
 import typing
 
 import tqdm
-import UnityPy
 from UnityPy.classes import Sprite, TextAsset, Texture2D
+from UnityPy.files import ObjectReader
 
-from gfunpack import utils
+from gfunpack import cache, checkpoint, governor, imaging, manifest, shards, trace, utils
 
 _logger = logging.getLogger('gfunpack.utils')
 _warning = _logger.warning
 
+_avgtexture_prefix = 'assets/resources/dabao/avgtexture/'
 _avgtexture_regex = re.compile('^assets/resources/dabao/avgtexture/([^/]+)\\.png$')
 
 
@@ -34,90 +35,192 @@ class BackgroundCollection:
 
     concurrency: int
 
+    referenced: set[str] | None
+    """Keys of `backgrounds.json` to extract, or `None` to extract everything."""
+
+    cgs: set[str]
+    """Keys of `backgrounds.json` used as CGs, encoded with the `cg` quality preset."""
+
+    output: imaging.ImageOutput
+
+    _cg_names: set[str]
+
+    texture_cache: cache.TextureCache | None
+
+    checkpoint: checkpoint.Checkpoint | None
+    """Resource files already extracted, with the backgrounds they contained."""
+
+    shard: shards.Shard | None
+    """Only extract the resource files of this shard, or `None` to extract all of them."""
+
+    _deduplicator: imaging.Deduplicator
+
     _semaphore: threading.Semaphore
 
-    def __init__(self, directory: str, destination: str, pngquant: bool = False, force: bool = False, concurrency: int = 8) -> None:
+    def __init__(self, directory: str, destination: str, pngquant: bool = False, force: bool = False, concurrency: int = 8,
+                 referenced: set[str] | None = None, cgs: set[str] | None = None,
+                 output: imaging.ImageOutput | None = None, texture_cache: cache.TextureCache | None = None,
+                 checkpoint: checkpoint.Checkpoint | None = None, shard: shards.Shard | None = None) -> None:
         self.directory = utils.check_directory(directory)
         self.destination = utils.check_directory(pathlib.Path(destination).joinpath('background'), create=True)
         self.pngquant = utils.test_pngquant(pngquant)
         self.force = force
         self.concurrency = concurrency
+        self.referenced = referenced
+        self.cgs = set() if cgs is None else cgs
+        self.output = imaging.ImageOutput() if output is None else output
+        self._cg_names = set()
+        self.texture_cache = texture_cache
+        self.checkpoint = checkpoint
+        self.shard = shard
+        self._deduplicator = imaging.Deduplicator(self.destination.joinpath('.digests.json'))
         self._semaphore = threading.Semaphore(concurrency)
         self.profile_asset = self.directory.joinpath('asset_textavg.ab')
-        self.resource_files = list(self.directory.glob('resource_avgtexture*.ab'))
-        self.extracted = self.extract()
+        self.resource_files = list(
+            f for f in self.directory.glob('resource_avgtexture*.ab')
+            if shard is None or shard.owns(f.name)
+        )
+        self.extracted = {}
 
     def _extract_bg_profiles(self) -> list[str]:
-        content = utils.read_text_asset(self.profile_asset, 'assets/resources/dabao/avgtxt/profiles.txt')
+        content = utils.read_text_asset(self.profile_asset, 'assets/resources/dabao/avgtxt/profiles.txt', 'backgrounds')
         return [l.strip() for l in content.split('\n')]
 
-    def _save_image(self, extracted: dict[str, pathlib.Path], name: str, image: Sprite | Texture2D):
-        image_path = self.destination.joinpath(f'{name}.png')
-        if self.force or not image_path.is_file():
-            image.image.save(image_path)
-            utils.pngquant(image_path, use_pngquant=self.pngquant)
-        extracted[name] = image_path
-        self._semaphore.release()
+    def _save_image(self, extracted: dict[str, pathlib.Path], name: str, image: Sprite | Texture2D | None,
+                    source: pathlib.Path):
+        try:
+            with trace.span(name, 'image'):
+                image_path = self.destination.joinpath(f'{name}.png')
+                decoded = None
+                if image is not None:
+                    with governor.get().cpu('backgrounds'):
+                        if self.texture_cache is None:
+                            decoded = image.image
+                        else:
+                            decoded = self.texture_cache.decode(self.texture_cache.key(source, image.path_id), image)
+                    duplicate = self._deduplicator.claim(imaging.pixel_digest(decoded), image_path)
+                    if duplicate is not None:
+                        extracted[name] = duplicate
+                        return
+                    self.output.save_png(decoded, image_path)
+                    utils.pngquant(image_path, use_pngquant=self.pngquant, stage='backgrounds')
+                category = 'cg' if name in self._cg_names else 'background'
+                self.output.encode(image_path, category, decoded, force=image is not None)
+                extracted[name] = image_path
+        finally:
+            self._semaphore.release()
 
-    def _extract_files(self, resources: dict[str, Sprite | Texture2D]):
+    def _extract_files(self, resources: dict[str, ObjectReader], source: pathlib.Path):
         extracted: dict[str, pathlib.Path] = {}
-        for name, image in resources.items():
-            self._semaphore.acquire()
-            threading.Thread(target=self._save_image, args=(extracted, name, image)).start()
+        for name, reader in resources.items():
+            image_path = self.destination.joinpath(f'{name}.png')
+            extracted_before = not self.force and image_path.is_file()
+            if extracted_before and self.output.is_complete(image_path):
+                extracted[name] = image_path
+                continue
+            with trace.span('semaphore', 'wait'):
+                self._semaphore.acquire()
+            # objects are read here since bundle readers are not thread-safe, decoding happens in the writer thread
+            # (only the encoding is missing for previously extracted images)
+            image = None if extracted_before else typing.cast(Sprite | Texture2D, reader.read())
+            threading.Thread(target=self._save_image, args=(extracted, name, image, source)).start()
         for _ in range(self.concurrency):
             self._semaphore.acquire()
         for _ in range(self.concurrency):
             self._semaphore.release()
-        return extracted
-
-    def _extract_bg_pics(self):
+        # duplicates are claimed before their canonical file is written, which may have failed since
+        return dict((name, path) for name, path in extracted.items() if path.is_file())
+
+    @classmethod
+    def _select_bg_objects(cls, objects: typing.Iterable[tuple[str, ObjectReader]], names: set[str] | None = None):
+        """
+        Picks one object for each background by metadata only, without reading any of them.
+        """
+        selected: dict[str, ObjectReader] = {}
+        for container, o in objects:
+            if o.type.name != 'Sprite' and o.type.name != 'Texture2D':
+                continue
+            match = _avgtexture_regex.match(container)
+            if match is None:
+                continue
+            name = match.group(1).lower()
+            if names is not None and name not in names:
+                continue
+            # prioritize Texture2D assets
+            if name not in selected or selected[name].type.name == 'Sprite':
+                selected[name] = o
+        return selected
+
+    def _extract_bg_pics(self, names: set[str] | None = None):
         extracted: dict[str, pathlib.Path] = {}
         for file in tqdm.tqdm(self.resource_files):
-            files: dict[str, Sprite | Texture2D] = {}
-            asset = UnityPy.load(str(file))
-            for o in tqdm.tqdm(asset.objects, leave=False):
-                if o.container is None:
-                    continue
-                if o.type.name != 'Sprite' and o.type.name != 'Texture2D':
-                    continue
-                match = _avgtexture_regex.match(o.container)
-                if match is None:
-                    continue
-                name = match.group(1).lower()
-                data = typing.cast(Sprite | Texture2D, o.read())
-                if name not in files:
-                    files[name] = data
-                else:
-                    # prioritize Texture2D assets
-                    if files[name].type.name == 'Sprite':
-                        files[name] = data
-            extracted.update(self._extract_files(files))
+            done = None if self.checkpoint is None else self.checkpoint.get('backgrounds', file.name)
+            if done is not None:
+                extracted.update((name, pathlib.Path(path)) for name, path in done.items())
+                continue
+            with trace.span(file.stem, 'bundle'):
+                index = utils.ContainerIndex.load(file, 'backgrounds')
+                files = self._select_bg_objects(index.prefix(_avgtexture_prefix), names)
+                pics = self._extract_files(files, file)
+            extracted.update(pics)
+            missing = set(files) - set(pics)
+            if len(missing) > 0:
+                # left out of the checkpoint so that a resumed run tries the bundle again
+                _warning('%s: %d backgrounds failed: %s', file.name, len(missing), sorted(missing))
+            elif self.checkpoint is not None:
+                self.checkpoint.complete('backgrounds', file.name, dict((k, str(v)) for k, v in pics.items()))
         return extracted
 
     def extract(self):
         bg_profiles = self._extract_bg_profiles()
-        pics = self._extract_bg_pics()
+        indices = list(range(len(bg_profiles)))
+        names = None
+        if self.referenced is not None:
+            indices = [i for i in indices if str(i) in self.referenced]
+            names = set(bg_profiles[i].lower() for i in indices)
+        self._cg_names = set(bg_profiles[int(k)].lower() for k in self.cgs if k.isdigit() and int(k) < len(bg_profiles))
+        pics = self._extract_bg_pics(names)
+        self._deduplicator.save()
         merged: dict[int, pathlib.Path | None] = {}
         matched: list[pathlib.Path] = []
-        for i, name in enumerate(bg_profiles):
+        for i in indices:
+            name = bg_profiles[i]
             match = pics.get(name.lower())
             merged[i] = match
             if match is not None:
                 matched.append(match.resolve())
-            else:
+            elif self.shard is None:
+                # left to the merge step for shards, since other shards may hold it
                 _warning('bg %s not found', name)
         unmatched = set(p.resolve() for p in pics.values()) - set(matched)
         for path in unmatched:
             merged[-len(merged)] = path
+        self.extracted = merged
         return merged
 
-    def save(self):
-        s = json.dumps(
-            dict((k, "" if v is None else str(v.relative_to(self.destination.parent))) for k, v in self.extracted.items()),
-            ensure_ascii=False,
-            indent=2,
-        )
-        path = self.destination.parent.joinpath('backgrounds.json')
+    def save(self, hashed: manifest.Manifest | None = None):
+        base = self.destination.parent
+
+        def publish(path: pathlib.Path):
+            return str((path if hashed is None else hashed.add(path, base)).relative_to(base))
+
+        published: dict[int, str] = {}
+        details: dict[int, dict[str, typing.Any]] = {}
+        for k, v in self.extracted.items():
+            if v is None:
+                published[k] = ""
+                continue
+            published[k] = publish(self.output.path(v))
+            details[k] = {'path': published[k], 'fallback': publish(v)}
+            if len(self.output.variants) > 0:
+                details[k]['variants'] = dict(
+                    (str(scale), publish(variant)) for scale, variant in self.output.variant_paths(v).items()
+                )
+        path = base.joinpath('backgrounds.json')
         with path.open('w') as f:
-            f.write(s)
+            f.write(json.dumps(published, ensure_ascii=False, indent=2))
+        if self.output.format != 'png' or len(self.output.variants) > 0:
+            # backgrounds.json stays a flat name -> url map for the viewer
+            with base.joinpath('backgrounds.details.json').open('w') as f:
+                f.write(json.dumps(details, ensure_ascii=False, indent=2))
         return path
@@ -0,0 +1,193 @@
+import logging
+import mmap
+import os
+import pathlib
+import struct
+import threading
+
+import UnityPy
+from PIL import Image
+from UnityPy.files import BundleFile
+
+from gfunpack import utils
+
+_logger = logging.getLogger('gfunpack.cache')
+_info = _logger.info
+_warning = _logger.warning
+
+
+class DiskCache:
+    """
+    A directory of cache entries bounded by a byte budget, evicting the least recently used entries first.
+
+    Recency is tracked through file modification times, so it carries over between runs.
+    """
+
+    directory: pathlib.Path
+
+    budget: int
+    """Maximum total size in bytes."""
+
+    suffix: str
+
+    _sizes: dict[str, int]
+
+    _lock: threading.Lock
+
+    def __init__(self, directory: pathlib.Path | str, budget: int, suffix: str) -> None:
+        self.directory = utils.check_directory(directory, create=True)
+        self.budget = budget
+        self.suffix = suffix
+        self._lock = threading.Lock()
+        self._sizes = dict((f.name, f.stat().st_size) for f in self.directory.glob(f'*{suffix}'))
+
+    def size(self):
+        return sum(self._sizes.values())
+
+    def entry(self, key: str):
+        return self.directory.joinpath(f'{key}{self.suffix}')
+
+    def touch(self, path: pathlib.Path):
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def commit(self, tmp: pathlib.Path, path: pathlib.Path):
+        """
+        Moves a fully written temporary file into the cache and evicts entries over budget.
+        """
+        size = tmp.stat().st_size
+        if size > self.budget:
+            tmp.unlink()
+            return False
+        os.replace(tmp, path)
+        with self._lock:
+            self._sizes[path.name] = size
+            self._evict()
+        return True
+
+    def _evict(self):
+        total = sum(self._sizes.values())
+        if total <= self.budget:
+            return
+        entries: list[tuple[int, str]] = []
+        for name in self._sizes:
+            try:
+                entries.append((self.directory.joinpath(name).stat().st_mtime_ns, name))
+            except FileNotFoundError:
+                entries.append((0, name))
+        for _, name in sorted(entries):
+            if total <= self.budget:
+                break
+            total -= self._sizes.pop(name)
+            # mapped entries stay readable until unmapped
+            self.directory.joinpath(name).unlink(missing_ok=True)
+
+
+_texture_header = struct.Struct('<8sII4s')
+_texture_magic = b'GFTEXT\x00\x02'
+
+_texture_modes = {'L': 1, 'LA': 2, 'RGB': 3, 'RGBA': 4}
+"""Cached image modes with their bytes per pixel, other modes are not cached."""
+
+
+class TextureCache(DiskCache):
+    """
+    Decoded textures stored as raw pixels behind a small header, keyed by bundle fingerprint and path id.
+
+    Entries are memory-mapped back into images of their original mode, skipping texture decompression altogether.
+    """
+
+    def __init__(self, directory: pathlib.Path | str, budget: int) -> None:
+        super().__init__(directory, budget, '.rgba')
+
+    @classmethod
+    def key(cls, bundle: pathlib.Path, path_id: int):
+        return f'{pathlib.Path(bundle).stem}-{utils.fingerprint(pathlib.Path(bundle))}-{path_id}'
+
+    def get(self, key: str) -> Image.Image | None:
+        path = self.entry(key)
+        if not self.touch(path):
+            return None
+        with path.open('rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, width, height, mode = _texture_header.unpack_from(mapped)
+        mode = mode.rstrip(b'\x00').decode(errors='replace')
+        if (magic != _texture_magic or mode not in _texture_modes
+                or len(mapped) != _texture_header.size + width * height * _texture_modes[mode]):
+            _warning('corrupted texture cache entry %s', path)
+            mapped.close()
+            path.unlink(missing_ok=True)
+            return None
+        # the image keeps a reference to the mapping, which is released with it
+        return Image.frombuffer(
+            mode, (width, height), memoryview(mapped)[_texture_header.size:], 'raw', mode, 0, 1,
+        )
+
+    def put(self, key: str, image: Image.Image):
+        if image.mode not in _texture_modes:
+            return
+        path = self.entry(key)
+        tmp = path.with_name(f'.{path.name}.{threading.get_ident()}.tmp')
+        with tmp.open('wb') as f:
+            f.write(_texture_header.pack(_texture_magic, image.width, image.height, image.mode.encode()))
+            f.write(image.tobytes())
+        self.commit(tmp, path)
+
+    def decode(self, key: str | None, obj) -> Image.Image:
+        """
+        Returns the decoded image of a `Texture2D` or `Sprite`, through the cache if `key` is given.
+        """
+        if key is None:
+            return obj.image
+        image = self.get(key)
+        if image is None:
+            image = obj.image
+            self.put(key, image)
+        return image
+
+
+class BundleCache(DiskCache):
+    """
+    Uncompressed copies of LZ4/LZMA-compressed bundles, keyed by bundle name and fingerprint.
+
+    The first stage loading a bundle pays for decompression once, all later loads read the plain copy.
+    """
+
+    def __init__(self, directory: pathlib.Path | str, budget: int) -> None:
+        super().__init__(directory, budget, '.ab')
+
+    @classmethod
+    def key(cls, bundle: pathlib.Path):
+        return f'{bundle.stem}-{utils.fingerprint(bundle)}'
+
+    @classmethod
+    def _is_compressed(cls, file: BundleFile):
+        return file.signature == 'UnityFS' and getattr(file, '_block_info_flags', 0) & 0x3F != 0
+
+    def locate(self, bundle: pathlib.Path):
+        """
+        Returns the uncompressed copy of the bundle if there is one.
+        """
+        path = self.entry(self.key(bundle))
+        return path if self.touch(path) else None
+
+    def store(self, bundle: pathlib.Path, env: UnityPy.Environment):
+        """
+        Writes an uncompressed copy of a freshly loaded bundle, if it was compressed at all.
+        """
+        files = list(env.files.values())
+        if len(files) != 1 or not isinstance(files[0], BundleFile) or not self._is_compressed(files[0]):
+            return None
+        path = self.entry(self.key(bundle))
+        tmp = path.with_name(f'.{path.name}.{threading.get_ident()}.tmp')
+        try:
+            with tmp.open('wb') as f:
+                f.write(files[0].save(packer='none'))
+        except Exception as e:
+            _warning('cannot cache %s', bundle, exc_info=e)
+            tmp.unlink(missing_ok=True)
+            return None
+        return path if self.commit(tmp, path) else None
@@ -136,6 +136,9 @@ class Chapters:
 
     def __init__(self, stories: Stories) -> None:
         self.stories = stories
+        self.all_chapters = {}
+
+    def categorize(self):
         self.chapters = self._fetch(_chapter_info_file, ChapterInfo)
         self.main_events = self._fetch(_event_info_file, EventStoryInfo)
         self.bonding_chapters = self._fetch(_bonding_chapter_file, BondingChapter)
@@ -146,6 +149,7 @@ class Chapters:
         self.sangvis_info, self.sangvis = self._fetch_and_index(_sangvis_info_file)
         self.skin_info, self.skins = self._fetch_and_index(_skins_info_file)
         self.all_chapters = self.categorize_stories()
+        return self.all_chapters
 
     def _fetch(self, file: str, item_type: typing.Type[T]) -> list[T]:
         with self.stories.gf_data_directory.joinpath('formatted', file).open() as f:
@@ -1,6 +1,6 @@
 import functools
+import json
 import logging
-import os
 import pathlib
 import re
 import subprocess
@@ -8,10 +8,10 @@ import threading
 import typing
 
 import tqdm
-import UnityPy
+from PIL import Image
 from UnityPy.classes import Sprite, Texture2D
 
-from gfunpack import database, prefabs, utils
+from gfunpack import atlas, cache, checkpoint, database, governor, imaging, prefabs, scratch, shards, tools, trace, utils
 
 _logger = logging.getLogger('gfunpack.character')
 _info = _logger.info
@@ -28,6 +28,9 @@ _alpha_postfixes = {
     'npc-sakura/Pic_Sakura_D.png': 'npc-sakura/Pic_Sakura_D_1.png',
 }
 
+# patched up after merging, with alpha layers that have to keep matching their images
+_untrimmed_images = set(_alpha_postfixes.keys()).union(_alpha_postfixes.values())
+
 
 class CharacterCollection:
     directory: pathlib.Path
@@ -38,6 +41,9 @@ class CharacterCollection:
 
     exported_images: dict[str, pathlib.Path]
 
+    written_images: set[pathlib.Path]
+    """Canonical (resolved) paths of all images this collection produced or found up to date."""
+
     db: database.Database
 
     character_index: dict[str, list[pathlib.Path]]
@@ -50,17 +56,54 @@ class CharacterCollection:
 
     verbose: bool
 
-    _semaphore: threading.Semaphore
+    referenced: set[tuple[str, int]] | None
+    """(lower-cased character, sprite index) pairs to extract, or `None` to extract everything."""
+
+    output: imaging.ImageOutput
+
+    trim: bool
+    """Whether to crop transparent borders off merged sprites."""
+
+    crops: dict[str, tuple[tuple[int, int, int, int], tuple[int, int]]]
+    """Crop boxes and original sizes of trimmed images, by path relative to `destination`."""
+
+    atlas_size: int | None
+    """Maximum atlas dimension when packing each character's sprites into atlases, or `None` to not pack."""
+
+    atlases: dict[pathlib.Path, atlas.CharacterAtlas]
+    """Atlases by character directory."""
 
-    _i: int
+    texture_cache: cache.TextureCache | None
+
+    checkpoint: checkpoint.Checkpoint | None
+    """Sprites already exported by an interrupted run, by `<character>/<index>` key."""
+
+    shard: shards.Shard | None
+    """Only extract the characters of this shard, or `None` to extract all of them."""
+
+    _sources: dict[int, pathlib.Path]
+    """Bundles of the required textures by path id, for the texture cache."""
+
+    _deduplicator: imaging.Deduplicator
+    """Canonical images by source path ids and by decoded pixels."""
+
+    _semaphore: threading.Semaphore
 
     def __init__(self, directory: str, destination: str, prefab_indices: prefabs.Prefabs,
-                 pngquant: bool = False, force: bool = False, concurrency=8, verbose: bool = False):
+                 pngquant: bool = False, force: bool = False, concurrency=8, verbose: bool = False,
+                 referenced: set[tuple[str, int]] | None = None, output: imaging.ImageOutput | None = None,
+                 trim: bool = False, atlas_size: int | None = None,
+                 texture_cache: cache.TextureCache | None = None, checkpoint: checkpoint.Checkpoint | None = None,
+                 shard: shards.Shard | None = None):
         self.image_details = prefab_indices.details
+        self.referenced = referenced
+        self.shard = shard
+        self.output = imaging.ImageOutput() if output is None else output
         self.required_path_ids = set(
             i
-            for details in prefab_indices.details.values()
-            for detail in details
+            for character, details in prefab_indices.details.items()
+            for j, detail in enumerate(details)
+            if self.is_referenced(character, j)
             for i in [detail.path_id, detail.alpha_path_id]
             if i != 0
         )
@@ -69,20 +112,74 @@ class CharacterCollection:
         db_path = str(self.destination.parent.joinpath('image.db').resolve())
         _info('database: %s', db_path)
         self.db = database.Database(db_path, directory)
-        self._i = 0
 
         self.exported_images = {}
+        self.written_images = set()
         self.character_index = {}
         self.pngquant = utils.test_pngquant(pngquant)
         self.force = force
         self.concurrency = concurrency
         self.verbose = verbose
+        self.trim = trim
+        self.crops = self._read_crops()
+        self.atlas_size = atlas_size
+        self.atlases = {}
+        self.texture_cache = texture_cache
+        self.checkpoint = checkpoint
+        self._sources = {}
+        # sprite paths are resolved, and so are the canonical paths read back
+        self._deduplicator = imaging.Deduplicator(self.destination.resolve().joinpath('.digests.json'))
         self._semaphore = threading.Semaphore(concurrency)
         self._test_commands()
 
-    def _unique_id(self):
-        self._i += 1
-        return self._i
+    def _read_crops(self):
+        path = self.destination.joinpath('crops.json')
+        if not path.is_file():
+            return {}
+        with path.open() as f:
+            crops = json.load(f)
+        return dict((k, (tuple(box), tuple(size))) for k, (box, size) in crops.items())
+
+    def _write_crops(self):
+        path = self.destination.joinpath('crops.json')
+        with path.open('w') as f:
+            f.write(json.dumps(dict(sorted(self.crops.items())), indent=2, ensure_ascii=False))
+
+    def crop_of(self, image_path: pathlib.Path):
+        return self.crops.get(image_path.relative_to(self.destination.resolve()).as_posix())
+
+    def _trim(self, image_path: pathlib.Path, file: pathlib.Path):
+        key = image_path.relative_to(self.destination.resolve()).as_posix()
+        self.crops.pop(key, None)
+        if not self.trim or key in _untrimmed_images:
+            return
+        crop = imaging.trim(file, self.output)
+        if crop is not None:
+            self.crops[key] = crop
+
+    def atlas_of(self, image_path: pathlib.Path):
+        character_atlas = self.atlases.get(image_path.parent)
+        return None if character_atlas is None else character_atlas.rects.get(image_path)
+
+    def build_atlases(self):
+        if self.atlas_size is None:
+            return
+        members: dict[pathlib.Path, set[pathlib.Path]] = {}
+        for image_path in self.exported_images.values():
+            if image_path.is_file():
+                members.setdefault(image_path.parent, set()).add(image_path)
+        rebuilt = 0
+        for directory, images in tqdm.tqdm(members.items()):
+            character_atlas = atlas.CharacterAtlas(directory, self.atlas_size)
+            if character_atlas.build(list(images), self.output, self.pngquant):
+                rebuilt += 1
+            self.atlases[directory] = character_atlas
+        _info('%d of %d character atlases rebuilt', rebuilt, len(members))
+
+    def is_referenced(self, character: str, i: int):
+        if self.shard is not None and not self.shard.owns(character.lower()):
+            return False
+        return self.referenced is None or (character.lower(), i) in self.referenced
 
     def _test_commands(self) -> None:
         try:
@@ -95,25 +192,68 @@ class CharacterCollection:
         Extracts all the sprites and textures from the given bundle.
         """
         path_id_index: dict[int, typing.Callable[[], Texture2D | Sprite]] = {}
-        for obj in UnityPy.load(bundle).objects:
+        for obj in utils.load_bundle(bundle, 'characters').objects:
             if obj.type.name != 'Sprite' and obj.type.name != 'Texture2D':
                 continue
             if obj.path_id == 0 or obj.path_id not in self.required_path_ids:
                 continue
             path_id_index[obj.path_id] = lambda id=obj.path_id: self.read_pic(bundle, id)
+            self._sources.setdefault(obj.path_id, pathlib.Path(bundle))
         return path_id_index
 
     @functools.lru_cache(maxsize=8)
     def read_pic(self, bundle: str, path_id: int):
-        bundle_env = UnityPy.load(bundle)
+        bundle_env = utils.load_bundle(bundle, 'characters')
         found = [obj for obj in bundle_env.objects if obj.path_id == path_id][0]
         return typing.cast(Sprite | Texture2D, found.read())
 
+    def _drop_unwritten(self):
+        """
+        Forgets sprites whose file was never written, including duplicates of a canonical file that failed
+        (duplicates are claimed before the canonical file is written).
+        """
+        for key, image_path in list(self.exported_images.items()):
+            if not image_path.is_file():
+                _warning('%s: canonical image %s was not written', key, image_path)
+                self.exported_images.pop(key)
+
+    def _complete(self, key: str, image_path: pathlib.Path):
+        if self.checkpoint is not None:
+            self.checkpoint.complete('characters', key, {'path': str(image_path), 'crop': self.crop_of(image_path)})
+
+    def _resume(self):
+        """
+        Restores the sprites exported by an interrupted run, returning their keys.
+        """
+        if self.checkpoint is None:
+            return set()
+        resumed: set[str] = set()
+        for key, done in self.checkpoint.items('characters').items():
+            image_path = pathlib.Path(done['path'])
+            if not image_path.is_file():
+                continue
+            self.exported_images[key] = image_path
+            self.written_images.add(image_path)
+            if done['crop'] is not None:
+                box, size = done['crop']
+                self.crops[image_path.relative_to(self.destination).as_posix()] = (tuple(box), tuple(size))
+            resumed.add(key)
+        return resumed
+
+    def _decode(self, image: Texture2D | Sprite):
+        with governor.get().cpu('characters'):
+            if self.texture_cache is None:
+                return image.image
+            source = self._sources.get(image.path_id)
+            key = None if source is None else self.texture_cache.key(source, image.path_id)
+            return self.texture_cache.decode(key, image)
+
     @classmethod
     def _has_alpha_channel(cls, pics: list[pathlib.Path]):
-        output = subprocess.check_output(
+        output = tools.check_output(
             ['magick', 'identify', '-format', '%[opaque]\\n']
             + [pic.resolve() for pic in pics],
+            'characters',
             text=True,
         )
         return [line.lower() == 'false' for line in output.split('\n') if line != '']
@@ -127,38 +267,54 @@ class CharacterCollection:
     def _merge_alpha_channel(self, directory: pathlib.Path, name: str, path_id: int, key: str,
                              sprite: Texture2D, alpha_sprite: Texture2D):
         try:
-            directory.mkdir(parents=True, exist_ok=True)
-            image_path = directory.joinpath(f'{name}.png').resolve()
-            self.exported_images[key] = image_path
-
-            if not self.force and image_path.exists():
-                return image_path
-            i = self._unique_id()
-            sprite_path = directory.joinpath(f'{name}.sprite-{i}.png')
-            alpha_path = directory.joinpath(f'{name}.alpha-{i}.png')
-            alpha_dims_path = directory.joinpath(f'{name}.dims-{i}.png')
-            if alpha_sprite.name.endswith('_Alpha'):
-                sprite.image.save(sprite_path)
-                alpha_sprite.image.save(alpha_path)
-                self._merge_files(sprite_path, alpha_path, alpha_dims_path, image_path)
-                # remove intermediate files
-                for file in (sprite_path, alpha_path, alpha_dims_path):
-                    os.remove(file)
-            else:
-                alpha_sprite.image.save(image_path)
-                if not self._has_alpha_channel([image_path])[0]:
-                    sprite.image.save(image_path)
-                if not self._has_alpha_channel([image_path])[0]:
-                    _warning('no alpha channel: %s', image_path)
-            utils.pngquant(image_path, use_pngquant=self.pngquant)
+            with trace.span(key, 'image', name=name):
+                directory.mkdir(parents=True, exist_ok=True)
+                image_path = directory.joinpath(f'{name}.png').resolve()
+                self.exported_images[key] = image_path
+
+                if not self.force and image_path.exists():
+                    self.written_images.add(image_path)
+                    self.output.encode(image_path, 'sprite')
+                    self._complete(key, image_path)
+                    return image_path
+                sprite_image = self._decode(sprite)
+                alpha_image = sprite_image if alpha_sprite is sprite else self._decode(alpha_sprite)
+                duplicate = self._deduplicator.claim(imaging.pixel_digest(sprite_image, alpha_image), image_path)
+                if duplicate is not None:
+                    self.exported_images[key] = duplicate
+                    self._complete(key, duplicate)
+                    return duplicate
+                self.written_images.add(image_path)
+                # intermediate files live in the scratch area, only the finished image is moved in
+                with scratch.get().files(
+                    f'{name}.sprite.png', f'{name}.alpha.png', f'{name}.dims.png', f'{name}.png',
+                    size=sprite_image.width * sprite_image.height * 4 * 4,
+                ) as (sprite_path, alpha_path, alpha_dims_path, merged_path):
+                    if alpha_sprite.name.endswith('_Alpha'):
+                        sprite_image.save(sprite_path)
+                        alpha_image.save(alpha_path)
+                        self._merge_files(sprite_path, alpha_path, alpha_dims_path, merged_path, self.output.effort)
+                    else:
+                        self.output.save_png(alpha_image, merged_path)
+                        if not self._has_alpha_channel([merged_path])[0]:
+                            self.output.save_png(sprite_image, merged_path)
+                        if not self._has_alpha_channel([merged_path])[0]:
+                            _warning('no alpha channel: %s', image_path)
+                    self._trim(image_path, merged_path)
+                    with Image.open(merged_path) as merged:
+                        merged.load()
+                        self.output.encode(image_path, 'sprite', merged, force=True)
+                    utils.pngquant(merged_path, use_pngquant=self.pngquant, stage='characters')
+                    scratch.commit(merged_path, image_path)
+                self._complete(key, image_path)
         finally:
             self._semaphore.release()
 
     @classmethod
     def _merge_files(cls, sprite_path: pathlib.Path, alpha_path: pathlib.Path,
-                     alpha_dims_path: pathlib.Path, image_path: pathlib.Path):
+                     alpha_dims_path: pathlib.Path, image_path: pathlib.Path, effort: int = 6):
         # resize to the same dimensions
-        subprocess.run([
+        tools.run([
             'magick',
             sprite_path,
             '-set',
@@ -170,21 +326,24 @@ class CharacterCollection:
             '-resize',
             '%[dims]',
             alpha_dims_path,
-        ]).check_returncode()
+        ], 'characters').check_returncode()
         # copy the alpha channel
-        subprocess.run([
+        tools.run([
             'magick',
             sprite_path,
             alpha_dims_path,
             '-compose',
             'copy-opacity',
             '-composite',
+            # zlib level and adaptive filtering
+            '-quality',
+            f'{effort}5',
             image_path,
-        ]).check_returncode()
+        ], 'characters').check_returncode()
 
     def read_single(self, info: database.Image):
         path = self.db.get_bundle_path(info.bundle)
-        bundle = UnityPy.load(str(path))
+        bundle = utils.load_bundle(path, 'characters')
         for obj in bundle.objects:
             if obj.path_id == info.path_id:
                 return typing.cast(Texture2D | Sprite, obj.read())
@@ -194,11 +353,14 @@ class CharacterCollection:
             self,
             path_id_index: dict[int, typing.Callable[[], Texture2D | Sprite]],
             sprites: list[int],
+            resumed: set[str],
     ):
         for character, details in (bar := tqdm.tqdm(self.image_details.items())):
             bar.set_description(character)
             for i, detail in enumerate(details):
                 assert character.lower() == detail.name.lower()
+                if not self.is_referenced(character, i) or f'{character}/{i}' in resumed:
+                    continue
                 path_id = detail.path_id
                 alpha_path_id = detail.alpha_path_id
                 if path_id not in path_id_index:
@@ -217,6 +379,7 @@ class CharacterCollection:
                             _warning(f'no image for _Alpha: {character}: {name} {detail}')
                             continue
                         path_id_index[info.path_id] = lambda info=info: self.read_single(info)
+                        self._sources[info.path_id] = self.db.get_bundle_path(info.bundle)
                         path_id = info.path_id
                         detail.path_id = path_id
                     else:
@@ -225,11 +388,21 @@ class CharacterCollection:
                 if alpha_path_id == 0:
                     _warning(f'no alpha channel: {character}: {detail}')
                     alpha_path_id = path_id
-                self._semaphore.acquire()
+                with trace.span('semaphore', 'wait'):
+                    self._semaphore.acquire()
                 image = path_id_index[path_id]()
                 alpha_image = path_id_index[alpha_path_id]()
                 name = image.name
                 assert name is not None and name != ''
+                # the same textures referenced by other prefabs (mod / npc variants) are merged only once
+                duplicate = self._deduplicator.claim(
+                    (path_id, alpha_path_id),
+                    self._get_image_destination(character.lower(), f'{name}.png'),
+                )
+                if duplicate is not None:
+                    self.exported_images[f'{character}/{i}'] = duplicate
+                    self._semaphore.release()
+                    continue
                 threading.Thread(
                     target=self._merge_alpha_channel,
                     args=(
@@ -249,29 +422,55 @@ class CharacterCollection:
 
     def _postfix(self):
         image = self._get_image_destination('npc-sakura', 'Pic_Sakura_D.png')
-        if not self._has_alpha_channel([image])[0]:
-            source = image.rename(image.with_suffix('.tmp.png'))
-            # crop the image, parameters manually acquired
-            subprocess.run([
-                'magick',
-                source,
-                '-crop',
-                '809x1367+782+13',
-                image,
-            ]).check_returncode()
-            source.unlink()
+        if image.is_file() and not self._has_alpha_channel([image])[0]:
+            with scratch.get().files(image.name, size=image.stat().st_size) as (cropped,):
+                # crop the image, parameters manually acquired
+                tools.run([
+                    'magick',
+                    image,
+                    '-crop',
+                    '809x1367+782+13',
+                    cropped,
+                ], 'characters').check_returncode()
+                scratch.commit(cropped, image)
+            self.output.encode(image, 'sprite', force=True)
+        pending: list[tuple[pathlib.Path, pathlib.Path]] = []
         for image_name, alpha_name in _alpha_postfixes.items():
             image = self._get_image_destination(image_name)
             alpha = self._get_image_destination(alpha_name)
-            source = image.with_suffix('.tmp.png')
-            dims = image.with_suffix('.dims.png')
-            image.rename(source)
-            self._merge_files(source, alpha, dims, image)
-            for f in [source, dims]:
-                f.unlink()
+            # not extracted when only referenced sprites are exported
+            if image.is_file() and alpha.is_file():
+                pending.append((image, alpha))
+        if len(pending) == 0:
+            return
+        # images merged by an earlier run already have their alpha channel and are left untouched
+        # (re-extracted ones, e.g. with --force, are opaque again), so that their atlases are not rebuilt
+        merged_before = self._has_alpha_channel([image for image, _ in pending])
+        for (image, alpha), done in zip(pending, merged_before):
+            if done:
+                continue
+            with scratch.get().files(
+                f'{image.stem}.dims.png', image.name, size=image.stat().st_size * 8,
+            ) as (dims, merged):
+                self._merge_files(image, alpha, dims, merged, self.output.effort)
+                scratch.commit(merged, image)
+            self.output.encode(image, 'sprite', force=True)
 
     def extract(self):
-        l = list(self.required_path_ids)
+        resumed = self._resume()
+        required_path_ids = self.required_path_ids
+        if len(resumed) > 0:
+            # bundles holding only finished sprites are not opened again
+            required_path_ids = set(
+                i
+                for character, details in self.image_details.items()
+                for j, detail in enumerate(details)
+                if self.is_referenced(character, j) and f'{character}/{j}' not in resumed
+                for i in [detail.path_id, detail.alpha_path_id]
+                if i != 0
+            )
+            _info('%d sprites resumed', len(resumed))
+        l = list(required_path_ids)
         images = self.db.get_by_path_ids(l)
         sprites = self.db.get_by_path_ids(l, True)
         bundles = set(image.bundle for image in images).union(
@@ -288,13 +487,14 @@ class CharacterCollection:
                 match = _character_file_regex.match(file)
                 group = bundle_name if match is None else match.group(1)
             bar.set_description(group)
-            extracted = self._extract_pics(file)
+            with trace.span(bundle_name, 'bundle'):
+                extracted = self._extract_pics(file)
             for path_id, img in extracted.items():
                 if path_id in path_id_index and 'avgpicprefab' in bundle_name:
                     continue
                 path_id_index[path_id] = img
 
-        if path_id_index.keys() != self.required_path_ids:
+        if path_id_index.keys() != required_path_ids:
             non_alpha_ids = set(
                 detail.path_id
                 for details in self.image_details.values()
@@ -302,6 +502,12 @@ class CharacterCollection:
                 if detail.path_id != 0
             )
             # transparency already merged into the alpha image
-            assert (self.required_path_ids - path_id_index.keys()).issubset(non_alpha_ids)
-        self._try_merging_alpha(path_id_index, [s.path_id for s in sprites])
+            assert (required_path_ids - path_id_index.keys()).issubset(non_alpha_ids)
+        self._try_merging_alpha(path_id_index, [s.path_id for s in sprites], resumed)
+        self._drop_unwritten()
+        self._deduplicator.save()
         self._postfix()
+        if self._deduplicator.duplicates > 0:
+            _info('%d duplicate images mapped to canonical files', self._deduplicator.duplicates)
+        self._write_crops()
+        self.build_atlases()
@@ -0,0 +1,107 @@
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+import typing
+
+_logger = logging.getLogger('gfunpack.checkpoint')
+_info = _logger.info
+
+
+class Checkpoint:
+    """
+    Items completed by each stage, persisted as they complete so that an interrupted run can be resumed.
+
+    Items are only recorded after their outputs are written; the file is rewritten atomically
+    at most every `interval` seconds and whenever a stage finishes.
+
+    `stages` are the ones about to run (all of them by default). Unless resuming, their entries are dropped,
+    while the entries of the other stages are kept for their own runs.
+    """
+
+    path: pathlib.Path
+
+    stages: dict[str, dict[str, typing.Any]]
+
+    finished: set[str]
+    """Stages that ran to the end, which resumed runs skip."""
+
+    interval: float
+
+    _dirty: bool
+
+    _saved: float
+
+    _lock: threading.RLock
+
+    def __init__(self, path: pathlib.Path | str, resume: bool = False, interval: float = 5.0,
+                 stages: typing.Iterable[str] | None = None) -> None:
+        self.path = pathlib.Path(path)
+        self.interval = interval
+        self.stages = {}
+        self.finished = set()
+        self._dirty = False
+        self._saved = time.monotonic()
+        self._lock = threading.RLock()
+        if self.path.is_file():
+            with self.path.open() as f:
+                data = json.load(f)
+            self.stages = data['stages']
+            self.finished = set(data['finished'])
+        if resume:
+            _info('resuming from %s: %s', self.path, dict((k, len(v)) for k, v in self.stages.items()))
+            return
+        for stage in set(self.stages) | self.finished if stages is None else stages:
+            if stage in self.stages or stage in self.finished:
+                self.stages.pop(stage, None)
+                self.finished.discard(stage)
+                self._dirty = True
+
+    def get(self, stage: str, item: str) -> typing.Any:
+        with self._lock:
+            return self.stages.get(stage, {}).get(item)
+
+    def done(self, stage: str, item: str):
+        with self._lock:
+            return item in self.stages.get(stage, {})
+
+    def items(self, stage: str):
+        with self._lock:
+            return dict(self.stages.get(stage, {}))
+
+    def complete(self, stage: str, item: str, value: typing.Any = True):
+        with self._lock:
+            self.stages.setdefault(stage, {})[item] = value
+            self._dirty = True
+            if time.monotonic() - self._saved >= self.interval:
+                self.save()
+
+    def finish(self, stage: str):
+        with self._lock:
+            self.finished.add(stage)
+            self._dirty = True
+            self.save()
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return self.path
+            tmp = self.path.with_name(f'.{self.path.name}.tmp')
+            with tmp.open('w') as f:
+                f.write(json.dumps({'finished': sorted(self.finished), 'stages': self.stages}, ensure_ascii=False))
+            os.replace(tmp, self.path)
+            self._dirty = False
+            self._saved = time.monotonic()
+            return self.path
+
+    def clear(self):
+        """
+        Forgets everything after a successful run.
+        """
+        with self._lock:
+            self.stages = {}
+            self.finished = set()
+            self._dirty = False
+            self.path.unlink(missing_ok=True)
@@ -5,9 +5,10 @@ import typing
 from pathlib import Path
 
 import tqdm
-import UnityPy
 from UnityPy.classes import Sprite, Texture2D
 
+from gfunpack import utils
+
 
 _logger = logging.getLogger('gfunpack.database')
 _warning = _logger.warning
@@ -88,11 +89,13 @@ class Database:
                 })''', [b for b, _ in removed_bundles])
                 cur.execute('DELETE FROM image WHERE bundle NOT IN (SELECT name FROM bundle)')
 
-            new_records: list[Image] = []
+            self.db.commit()
+            sizes = dict(now_bundles)
             for path in tqdm.tqdm(self.bundles):
                 if path.stem not in new_bundles:
                     continue
-                bundle = UnityPy.load(str(path))
+                new_records: list[Image] = []
+                bundle = utils.load_bundle(path, 'characters')
                 for obj in bundle.objects:
                     if obj.type.name == 'Texture2D':
                         image = typing.cast(Texture2D, obj.read())
@@ -120,15 +123,14 @@ class Database:
                         continue
                     new_records.append(info)
 
-            if len(new_records) > 0:
+                # committed bundle by bundle so that an interrupted scan resumes where it stopped
+                cur.execute('DELETE FROM image WHERE bundle = ?', (path.stem,))
                 cur.executemany(
                     f'INSERT INTO image ({_image_fields}) VALUES ({_image_field_placeholders})',
                     ((r.path_id, r.name, r.is_sprite, r.width, r.height, r.bundle, r.container) for r in new_records),
                 )
-            cur.executemany(
-                'INSERT INTO bundle (name, size) VALUES (?, ?)',
-                list(now_bundles - db_bundles),
-            )
+                cur.execute('INSERT OR REPLACE INTO bundle (name, size) VALUES (?, ?)', (path.stem, sizes[path.stem]))
+                self.db.commit()
         finally:
             cur.close()
             self.db.commit()
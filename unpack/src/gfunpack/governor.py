@@ -0,0 +1,169 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import os
+import threading
+import typing
+
+from gfunpack import trace
+
+_logger = logging.getLogger('gfunpack.governor')
+_info = _logger.info
+
+priorities = {
+    'characters': 0,
+    'backgrounds': 1,
+    'stories': 1,
+    'audio': 2,
+}
+"""Stage priorities, lower ones are served first."""
+
+default_priority = 1
+
+_thread_limits = ('OMP_NUM_THREADS', 'OMP_THREAD_LIMIT', 'MAGICK_THREAD_LIMIT')
+
+
+class _Pool:
+    """
+    A counting semaphore granting units to waiters by priority, first come first served within a priority.
+
+    Both threads and asyncio tasks can wait on it.
+    """
+
+    size: int
+
+    _available: int
+
+    _waiting: list[tuple[int, int, int, typing.Callable[[], None]]]
+
+    _counter: typing.Iterator[int]
+
+    _lock: threading.Lock
+
+    def __init__(self, size: int) -> None:
+        self.size = max(1, size)
+        self._available = self.size
+        self._waiting = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def _dispatch(self):
+        while len(self._waiting) > 0 and self._waiting[0][2] <= self._available:
+            _, _, units, grant = heapq.heappop(self._waiting)
+            self._available -= units
+            grant()
+
+    def _request(self, priority: int, units: int, grant: typing.Callable[[], None]):
+        ticket = (priority, next(self._counter), units, grant)
+        with self._lock:
+            heapq.heappush(self._waiting, ticket)
+            self._dispatch()
+        return ticket
+
+    def acquire(self, priority: int, units: int = 1):
+        units = min(units, self.size)
+        granted = threading.Event()
+        self._request(priority, units, granted.set)
+        granted.wait()
+        return units
+
+    async def acquire_async(self, priority: int, units: int = 1):
+        units = min(units, self.size)
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        state = {'granted': False}
+
+        def grant():
+            # called with the lock held, possibly from another thread
+            state['granted'] = True
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        ticket = self._request(priority, units, grant)
+        try:
+            await granted
+        except asyncio.CancelledError:
+            with self._lock:
+                if not state['granted']:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    raise
+            self.release(units)
+            raise
+        return units
+
+    def release(self, units: int = 1):
+        with self._lock:
+            self._available += units
+            self._dispatch()
+
+
+class Governor:
+    """
+    Process-wide CPU slots and I/O tokens shared by all stages.
+
+    Each slot stands for one core: external tools get as many threads as the slots they hold,
+    so that all stages together keep the load near the core count.
+    """
+
+    cpus: int
+
+    io: int
+
+    _cpu: _Pool
+
+    _io: _Pool
+
+    def __init__(self, cpus: int | None = None, io: int = 4) -> None:
+        self.cpus = max(1, cpus or os.cpu_count() or 2)
+        self.io = max(1, io)
+        self._cpu = _Pool(self.cpus)
+        self._io = _Pool(self.io)
+
+    @contextlib.contextmanager
+    def cpu(self, stage: str, slots: int = 1):
+        with trace.span('cpu', 'wait', stage=stage):
+            slots = self._cpu.acquire(priorities.get(stage, default_priority), slots)
+        try:
+            yield slots
+        finally:
+            self._cpu.release(slots)
+
+    @contextlib.asynccontextmanager
+    async def cpu_async(self, stage: str, slots: int = 1):
+        slots = await self._cpu.acquire_async(priorities.get(stage, default_priority), slots)
+        try:
+            yield slots
+        finally:
+            self._cpu.release(slots)
+
+    @contextlib.contextmanager
+    def io_token(self, stage: str):
+        with trace.span('io', 'wait', stage=stage):
+            self._io.acquire(priorities.get(stage, default_priority))
+        try:
+            yield
+        finally:
+            self._io.release()
+
+    @classmethod
+    def environ(cls, threads: int):
+        env = dict(os.environ)
+        for name in _thread_limits:
+            env[name] = str(threads)
+        return env
+
+
+_governor = Governor()
+
+
+def configure(cpus: int | None = None, io: int = 4):
+    global _governor
+    _governor = Governor(cpus, io)
+    _info('resource governor: %d cpu slots, %d io tokens', _governor.cpus, _governor.io)
+    return _governor
+
+
+def get():
+    return _governor
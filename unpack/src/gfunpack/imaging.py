@@ -0,0 +1,229 @@
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import re
+import threading
+import typing
+
+if typing.TYPE_CHECKING:
+    # PIL is imported by the functions using it, so that the CLI can list formats and categories without it
+    from PIL import Image
+
+_logger = logging.getLogger('gfunpack.imaging')
+_warning = _logger.warning
+
+image_formats = ('png', 'webp', 'avif')
+
+categories = ('background', 'cg', 'sprite')
+
+_variant_regex = re.compile('@\\d+$')
+
+default_quality = {
+    'background': 80,
+    'cg': 88,
+    'sprite': 90,
+}
+
+
+def is_variant(path: pathlib.Path):
+    return _variant_regex.search(path.stem) is not None
+
+
+def pixel_digest(*images: 'Image.Image'):
+    """
+    Hashes decoded pixel data, so that identical artwork stored under different names can be told apart cheaply.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    for image in images:
+        digest.update(f'{image.mode}:{image.width}x{image.height};'.encode())
+        digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class Deduplicator:
+    """
+    Thread-safe registry of canonical files by content key.
+
+    Digests (string keys) are persisted to `path`, since canonical files kept from earlier runs are not decoded
+    and hashed again: without them, duplicates would be written out again on every incremental run.
+    """
+
+    canonical: dict[typing.Hashable, pathlib.Path]
+
+    duplicates: int
+
+    path: pathlib.Path | None
+    """File keeping the digests of canonical files across runs, or `None` to forget them."""
+
+    _lock: threading.Lock
+
+    def __init__(self, path: pathlib.Path | None = None) -> None:
+        self.canonical = {}
+        self.duplicates = 0
+        self.path = path
+        self._lock = threading.Lock()
+        if path is not None and path.is_file():
+            with path.open() as f:
+                for key, rel in json.load(f).items():
+                    canonical = path.parent.joinpath(rel)
+                    if canonical.is_file():
+                        self.canonical[key] = canonical
+
+    def claim(self, key: typing.Hashable, path: pathlib.Path):
+        """
+        Registers `path` for `key` unless another file already holds the same content,
+        returning the canonical file in that case and `None` otherwise.
+
+        The canonical file may still be being written, or fail: check it before publishing a duplicate.
+        """
+        with self._lock:
+            existing = self.canonical.setdefault(key, path)
+            if existing == path:
+                return None
+            self.duplicates += 1
+            return existing
+
+    def save(self):
+        if self.path is None:
+            return None
+        with self._lock:
+            digests = dict(
+                (key, path.relative_to(self.path.parent).as_posix())
+                for key, path in self.canonical.items()
+                if isinstance(key, str) and path.is_relative_to(self.path.parent) and path.is_file()
+            )
+        tmp = self.path.with_name(f'.{self.path.name}.tmp')
+        with tmp.open('w') as f:
+            f.write(json.dumps(dict(sorted(digests.items())), ensure_ascii=False))
+        os.replace(tmp, self.path)
+        return self.path
+
+
+def trim(png_path: pathlib.Path, output: 'ImageOutput'):
+    """
+    Crops the image in place to the bounding box of its non-transparent pixels, saving it with the effort of `output`.
+
+    Returns the crop box `(left, top, right, bottom)` and the original size, or `None` if nothing was cropped.
+    """
+    from PIL import Image
+
+    with Image.open(png_path) as image:
+        if 'A' not in image.getbands() and 'transparency' not in image.info:
+            return None
+        image.load()
+        rgba = image if image.mode == 'RGBA' else image.convert('RGBA')
+        box = rgba.getchannel('A').getbbox()
+        size = image.size
+        if box is None or box == (0, 0, *size):
+            return None
+        tmp = png_path.with_name(f'.{png_path.name}.tmp')
+        output.save_png(image.crop(box), tmp)
+    tmp.replace(png_path)
+    return box, size
+
+
+def test_image_format(image_format: str):
+    if image_format not in image_formats:
+        raise ValueError(f'unsupported image format {image_format}')
+    from PIL import features
+
+    if image_format != 'png' and not features.check(image_format):
+        _warning('%s not supported by this PIL build, falling back to png', image_format)
+        return 'png'
+    return image_format
+
+
+@dataclasses.dataclass
+class ImageOutput:
+    """
+    The format images are published in.
+
+    PNG files are always written (and kept as fallbacks); other formats are encoded next to them
+    with per-category (`background`, `cg`, `sprite`) quality presets.
+    Downscaled variants (`<name>@<percent>.<ext>`) are produced from the same decoded image.
+    """
+
+    format: str = 'png'
+
+    quality: dict[str, int] = dataclasses.field(default_factory=lambda: dict(default_quality))
+
+    variants: tuple[int, ...] = ()
+    """Scales of the downscaled variants, in percent."""
+
+    effort: int = 6
+    """Encoder effort, from 0 (fastest) to 9 (smallest files)."""
+
+    def __post_init__(self):
+        self.format = test_image_format(self.format)
+        unknown = self.quality.keys() - set(categories)
+        if len(unknown) > 0:
+            raise ValueError(f'unknown image categories {unknown}')
+        self.quality = {**default_quality, **self.quality}
+        if any(v <= 0 or v >= 100 for v in self.variants):
+            raise ValueError(f'variant scales must be within (0, 100): {self.variants}')
+        if not 0 <= self.effort <= 9:
+            raise ValueError(f'encoder effort must be within [0, 9]: {self.effort}')
+
+    def path(self, png_path: pathlib.Path):
+        return png_path if self.format == 'png' else png_path.with_suffix(f'.{self.format}')
+
+    def variant_paths(self, png_path: pathlib.Path):
+        path = self.path(png_path)
+        return dict((scale, path.with_stem(f'{path.stem}@{scale}')) for scale in self.variants)
+
+    def encode(self, png_path: pathlib.Path, category: str, image: 'Image.Image | None' = None, force: bool = False):
+        """
+        Encodes the image (or the PNG file if no decoded image is at hand) into the output format
+        as well as into all variants.
+        """
+        path = self.path(png_path)
+        pending: dict[int, pathlib.Path] = dict(
+            (scale, variant) for scale, variant in self.variant_paths(png_path).items()
+            if force or not variant.is_file()
+        )
+        if path != png_path and (force or not path.is_file()):
+            pending[100] = path
+        if len(pending) == 0:
+            return path
+        if image is None:
+            from PIL import Image
+
+            with Image.open(png_path) as png:
+                png.load()
+                self._save_all(png, pending, category)
+        else:
+            self._save_all(image, pending, category)
+        return path
+
+    def is_complete(self, png_path: pathlib.Path):
+        return png_path.is_file() and self.path(png_path).is_file() and all(
+            variant.is_file() for variant in self.variant_paths(png_path).values()
+        )
+
+    def _save_all(self, image: 'Image.Image', pending: dict[int, pathlib.Path], category: str):
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+        for scale, path in pending.items():
+            if scale == 100:
+                self._save(image, path, category)
+            else:
+                from PIL import Image
+
+                size = (max(1, image.width * scale // 100), max(1, image.height * scale // 100))
+                self._save(image.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0), path, category)
+
+    def save_png(self, image: 'Image.Image', path: pathlib.Path):
+        image.save(path, format='PNG', compress_level=self.effort)
+
+    def _save(self, image: 'Image.Image', path: pathlib.Path, category: str):
+        tmp = path.with_name(f'.{path.name}.tmp')
+        if self.format == 'png':
+            self.save_png(image, tmp)
+        elif self.format == 'webp':
+            image.save(tmp, format='WEBP', quality=self.quality[category], method=round(self.effort * 6 / 9))
+        else:
+            image.save(tmp, format=self.format.upper(), quality=self.quality[category], speed=10 - self.effort)
+        tmp.replace(path)
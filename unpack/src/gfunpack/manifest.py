@@ -0,0 +1,146 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+
+_logger = logging.getLogger('gfunpack.manifest')
+_info = _logger.info
+_warning = _logger.warning
+
+hashed_directory = '_hashed'
+
+
+def file_digest(path: pathlib.Path) -> str:
+    with path.open('rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+class Manifest:
+    """
+    Content-hashed copies of emitted assets, so that they can be served as `immutable`.
+
+    Each asset `<category>/<path>/<name>.<ext>` gets a copy at `<category>/_hashed/<name>.<hash>.<ext>`
+    (hard-linked when possible, leaving the original in place for incremental runs),
+    and `manifest.json` maps logical paths to hashed ones, both relative to the output root.
+    Stories are left out, since `chapters.json` and the viewer refer to them by name.
+    """
+
+    root: pathlib.Path
+
+    assets: dict[str, str]
+
+    digest_length: int
+
+    def __init__(self, root: pathlib.Path | str, digest_length: int = 16) -> None:
+        self.root = pathlib.Path(root).resolve()
+        self.assets = {}
+        self.digest_length = digest_length
+
+    def add(self, path: pathlib.Path, base: pathlib.Path) -> pathlib.Path:
+        """
+        Returns the content-hashed copy of `path`, creating it under `base` if needed.
+        """
+        path = path.resolve()
+        digest = file_digest(path)[:self.digest_length]
+        directory = base.resolve().joinpath(hashed_directory)
+        directory.mkdir(exist_ok=True)
+        hashed = directory.joinpath(f'{path.stem}.{digest}{path.suffix}')
+        if not hashed.is_file():
+            tmp = hashed.with_name(f'.{hashed.name}.tmp')
+            try:
+                os.link(path, tmp)
+            except OSError:
+                shutil.copyfile(path, tmp)
+            os.replace(tmp, hashed)
+        self.assets[path.relative_to(self.root).as_posix()] = hashed.relative_to(self.root).as_posix()
+        return hashed
+
+    def load(self):
+        """
+        Keeps the entries of the existing `manifest.json`, for assets of stages that are not run again.
+        """
+        path = self.root.joinpath('manifest.json')
+        if path.is_file():
+            with path.open() as f:
+                self.assets.update(json.load(f))
+        return self
+
+    def save(self):
+        path = self.root.joinpath('manifest.json')
+        with path.open('w') as f:
+            f.write(json.dumps(dict(sorted(self.assets.items())), indent=2, ensure_ascii=False))
+        return path
+
+
+published_directories = ('images', 'audio', 'stories')
+
+published_suffixes = {'.png', '.webp', '.avif', '.m4a', '.txt', '.json'}
+
+internal_files = {'images/crops.json'}
+"""Bookkeeping of incremental runs under the published directories. Dotfiles (checkpoints, atlas fingerprints,
+pixel digests, caches) are never published either."""
+
+
+def index_files(root: pathlib.Path, previous: dict[str, dict] | None = None):
+    """
+    Lists published files under `root` with their content hashes.
+
+    Hashes are reused from `previous` for files whose size and mtime did not change.
+    """
+    previous = previous or {}
+    files: dict[str, dict] = {}
+    candidates = [root.joinpath('manifest.json')]
+    for name in published_directories:
+        candidates.extend(root.joinpath(name).rglob('*'))
+    for path in candidates:
+        if not path.is_file() or path.name.startswith('.') or path.suffix not in published_suffixes:
+            continue
+        rel = path.relative_to(root).as_posix()
+        if rel in internal_files:
+            continue
+        stat = path.stat()
+        record = previous.get(rel)
+        if record is None or record['size'] != stat.st_size or record['mtime_ns'] != stat.st_mtime_ns:
+            record = {'sha256': file_digest(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        files[rel] = record
+    return files
+
+
+def diff_files(previous: dict[str, dict], current: dict[str, dict]):
+    return {
+        'added': sorted(current.keys() - previous.keys()),
+        'changed': sorted(
+            path for path in current.keys() & previous.keys()
+            if current[path]['sha256'] != previous[path]['sha256']
+        ),
+        'removed': sorted(previous.keys() - current.keys()),
+    }
+
+
+def write_delta(root: pathlib.Path | str, previous_index: pathlib.Path | str | None = None):
+    """
+    Indexes the output tree into `publish.json` and writes `delta.json` against the previous index.
+
+    `delta.json` lists added, changed and removed paths (relative to `root`) for an uploader to consume.
+    """
+    root = pathlib.Path(root)
+    index_path = root.joinpath('publish.json')
+    previous_path = index_path if previous_index is None else pathlib.Path(previous_index)
+    previous: dict[str, dict] = {}
+    if previous_path.is_file():
+        with previous_path.open() as f:
+            previous = json.load(f)
+    else:
+        _warning('no previous publish index at %s, treating everything as added', previous_path)
+    current = index_files(root, previous)
+    delta = diff_files(previous, current)
+    with index_path.open('w') as f:
+        f.write(json.dumps(current, indent=2, ensure_ascii=False))
+    delta_path = root.joinpath('delta.json')
+    with delta_path.open('w') as f:
+        f.write(json.dumps(delta, indent=2, ensure_ascii=False))
+    _info('delta: %d added, %d changed, %d removed',
+          len(delta['added']), len(delta['changed']), len(delta['removed']))
+    return delta_path
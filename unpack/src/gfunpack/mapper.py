@@ -4,9 +4,14 @@ import dataclasses
 import pathlib
 import typing
 
-from gfunpack.characters import CharacterCollection
+from gfunpack.imaging import is_variant
+from gfunpack.manifest import Manifest, hashed_directory
 from gfunpack.prefabs import DialoguePicDetails, Prefabs
 
+if typing.TYPE_CHECKING:
+    # stories only need `SpriteDetails`, without the imaging stack of the characters
+    from gfunpack.characters import CharacterCollection
+
 _logger = logging.getLogger('gfunpack.prefabs')
 _warning = _logger.warning
 
@@ -16,20 +21,62 @@ class SpriteDetails:
     path: pathlib.Path
     scale: float = -1.0
     offset: tuple[float, float] = (0.0, 0.0)
+    center: tuple[float, float] = (-1.0, -1.0)
+    """The pixel of the image the viewer centers, or `(-1, -1)` for the middle of the image."""
+    fallback: pathlib.Path | None = None
+    """The PNG version when `path` is in another image format."""
+    variants: dict[str, pathlib.Path] | None = None
+    """Downscaled versions by scale in percent."""
+    crop: tuple[int, int, int, int] | None = None
+    """The box `(left, top, right, bottom)` the image was trimmed to, in pixels of the original image."""
+    canvas: tuple[int, int] | None = None
+    """The original image size when trimmed."""
+    atlas: pathlib.Path | None = None
+    """The atlas the sprite is packed into."""
+    rect: tuple[int, int, int, int] | None = None
+    """`(x, y, width, height)` of the sprite inside `atlas`."""
+
+
+def trimmed_offset(offset: tuple[float, float], crop: tuple[int, int, int, int], canvas: tuple[int, int]):
+    """
+    Moves the offset (y pointing up) by how many pixels trimming moved the image center.
+    """
+    left, top, right, bottom = crop
+    width, height = canvas
+    return (
+        offset[0] + (left + right - width) / 2,
+        offset[1] - (top + bottom - height) / 2,
+    )
+
+
+def trimmed_geometry(scale: float, crop: tuple[int, int, int, int], canvas: tuple[int, int]):
+    """
+    The scale and center that place a trimmed image where the original one was.
+
+    The viewer scales images to the stage height and centers them, so the crop is folded into both.
+    """
+    left, top, _, bottom = crop
+    width, height = canvas
+    return (
+        (scale if scale > 0 else 1) * (bottom - top) / height,
+        (width / 2 - left, height / 2 - top),
+    )
 
 
 class Mapper:
     prefabs: Prefabs
 
-    characters: CharacterCollection
+    characters: 'CharacterCollection'
 
     mapped: dict[str, dict[int, dict]]
 
-    def __init__(self, prefabs: Prefabs, characters: CharacterCollection):
+    verify: bool
+
+    def __init__(self, prefabs: Prefabs, characters: 'CharacterCollection', verify: bool = False):
         self.prefabs = prefabs
         self.characters = characters
+        self.verify = verify
         self.mapped = {}
-        self.map_sprite_path_ids()
 
     def _map_pic(self, character: str, i: int):
         result = self.characters.exported_images.get(f'{character}/{i}')
@@ -40,14 +87,32 @@ class Mapper:
         asdict = dataclasses.asdict(d)
         sprite_details = typing.cast(SpriteDetails, d)
         asdict['path'] = str(sprite_details.path.relative_to(self.characters.destination))
+        if sprite_details.fallback is None:
+            asdict.pop('fallback')
+        else:
+            asdict['fallback'] = str(sprite_details.fallback.relative_to(self.characters.destination))
+        if sprite_details.variants is not None:
+            asdict['variants'] = dict(
+                (scale, str(variant.relative_to(self.characters.destination)))
+                for scale, variant in sprite_details.variants.items()
+            )
+        if sprite_details.atlas is not None:
+            asdict['atlas'] = str(sprite_details.atlas.relative_to(self.characters.destination))
+        for k in ('variants', 'crop', 'canvas', 'atlas', 'rect'):
+            if asdict[k] is None:
+                asdict.pop(k)
+        if sprite_details.center == (-1.0, -1.0):
+            asdict.pop('center')
         if name not in dest:
             dest[name] = {}
         dest[name][i] = asdict
 
     def map_sprite_path_ids(self):
-        mapped_paths: list[pathlib.Path] = []
+        mapped_paths: set[pathlib.Path] = set()
         for name, details in self.prefabs.details.items():
             for i, detail in enumerate(details):
+                if not self.characters.is_referenced(name, i):
+                    continue
                 path = None if detail.path_id == 0 else self._map_pic(name, i)
                 if detail.path_id == 0:
                     _warning('%s (%d) (with empty path_id) not processed', name, i)
@@ -55,24 +120,64 @@ class Mapper:
                 elif path == None:
                     _warning('%s (%d) (path_id=%d) path_id not found', name, i, detail.path_id)
                     continue
-                self._add_mapped(name, i, SpriteDetails(path, detail.scale, detail.offset))
-                mapped_paths.append(path.resolve())
+                published = self.characters.output.path(path)
+                crop, canvas = self.characters.crop_of(path) or (None, None)
+                atlas, rect = self.characters.atlas_of(path) or (None, None)
+                scale, offset, center = detail.scale, detail.offset, (-1.0, -1.0)
+                if crop is not None and canvas is not None:
+                    scale, center = trimmed_geometry(scale, crop, canvas)
+                    offset = trimmed_offset(offset, crop, canvas)
+                self._add_mapped(name, i, SpriteDetails(
+                    published, scale, offset, center,
+                    fallback=None if published == path else path,
+                    variants=dict(
+                        (str(scale), variant) for scale, variant in self.characters.output.variant_paths(path).items()
+                    ) or None,
+                    crop=crop,
+                    canvas=canvas,
+                    atlas=None if atlas is None else self.characters.output.path(atlas),
+                    rect=rect,
+                ))
+                mapped_paths.add(path)
 
-        extracted = set(path.resolve() for path in self.characters.destination.glob('*/*.png'))
-        remaining: list[pathlib.Path] = sorted(
-            path for path in (extracted - set(mapped_paths))
-        )
+        if self.verify:
+            from gfunpack.atlas import is_atlas
+            extracted = set(
+                path.resolve() for path in self.characters.destination.glob('*/*.png')
+                if not is_variant(path) and not is_atlas(path)
+            )
+            mapped_paths = set(path.resolve() for path in mapped_paths)
+        else:
+            # exported paths are already canonical
+            extracted = self.characters.written_images
+        remaining: list[pathlib.Path] = sorted(extracted - mapped_paths)
         if len(remaining) > 0:
             categorized = {}
             for path in remaining:
-                if path.parent.name == 'background':
+                if path.parent.name in ('background', hashed_directory):
                     continue
                 name, path = path.parts[-2:]
                 categorized.setdefault(name, []).append(path)
             _warning('%d remaining images: %s', len(remaining), categorized)
 
-    def write_indices(self):
+    def write_indices(self, hashed: Manifest | None = None):
         data = self.mapped
+        if hashed is not None:
+            base = self.characters.destination
+            def publish(path: str):
+                return str(hashed.add(base.joinpath(path), base).relative_to(base))
+
+            data = dict(
+                (name, dict(
+                    (i, {
+                        **d,
+                        **dict((k, publish(d[k])) for k in ('path', 'fallback', 'atlas') if k in d),
+                        **({'variants': dict((k, publish(v)) for k, v in d['variants'].items())} if 'variants' in d else {}),
+                    })
+                    for i, d in sprites.items()
+                ))
+                for name, sprites in data.items()
+            )
         path = self.characters.destination.joinpath(f'mapped.json')
         with open(path, 'w') as f:
             f.write(json.dumps(data, indent=2, ensure_ascii=False))
@@ -0,0 +1,41 @@
+import argparse
+import logging
+import pathlib
+
+from gfunpack import manifest, shards
+
+_warning = logging.getLogger('gfunpack.merge').warning
+
+
+parser = argparse.ArgumentParser(description='combines the outputs of `python -m gfunpack --shard I/N` runs')
+parser.add_argument('parts', nargs='+', help='output directories of all shards')
+parser.add_argument('-o', '--output', required=True)
+parser.add_argument('--gf-data', help='gf-data-ch checkout for the chapter index (defaults to the one in the output directory)')
+parser.add_argument('--delta', action='store_true',
+                    help='index published files into publish.json and list changes since the last run in delta.json')
+parser.add_argument('--previous', help='publish.json of the previous run (defaults to the one in the output directory)')
+
+
+def main(argv: list[str] | None = None):
+    args = parser.parse_args(argv)
+    destination = shards.merge(args.output, args.parts)
+    gf_data = pathlib.Path(args.gf_data) if args.gf_data else destination.joinpath('gf-data-ch')
+    scripts = shards.raw_scripts(args.parts)
+    if len(scripts) > 0:
+        # shards only see their own resources, so stories are transpiled here against the merged indexes
+        from gfunpack import stories
+        ss = stories.Stories.link(str(destination.joinpath('stories')), scripts, str(gf_data))
+        ss.save()
+        if gf_data.joinpath('formatted').is_dir():
+            from gfunpack import chapters
+            cs = chapters.Chapters(ss)
+            cs.categorize()
+            cs.save()
+        else:
+            _warning('%s not found, chapters.json is not generated', gf_data)
+    if args.delta:
+        manifest.write_delta(destination, args.previous)
+
+
+if __name__ == '__main__':
+    main()
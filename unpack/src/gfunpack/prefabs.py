@@ -1,14 +1,16 @@
 import dataclasses
+import json
 import logging
+import os
 import pathlib
 import re
 import typing
 
-import UnityPy
-from UnityPy import Environment
-from UnityPy.classes import GameObject, MonoBehaviour, MonoScript
+from UnityPy.classes import GameObject, MonoBehaviour, MonoScript, PPtr
+from UnityPy.enums import BuildTarget
+from UnityPy.files import ObjectReader
 
-from gfunpack import utils
+from gfunpack import trace, utils
 
 _logger = logging.getLogger('gfunpack.prefabs')
 _warning = _logger.warning
@@ -23,7 +25,15 @@ class DialoguePicDetails:
     scale: float = -1.0
     offset: tuple[float, float] = (0.0, 0.0)
 
+    @classmethod
+    def from_dict(cls, d: dict[str, typing.Any]):
+        return cls(**{**d, 'offset': tuple(d['offset'])})
+
 
+cache_version = 1
+"""Format of `prefabs.cache.json`, bumped whenever `DialoguePicDetails` or the cache layout changes."""
+
+_path_prefix = 'assets/resources/dabao/avgpicprefabs/'
 _path_regex = re.compile('^assets/resources/dabao/avgpicprefabs/([^/]+)\\.prefab$')
 
 
@@ -34,45 +44,76 @@ class Prefabs:
 
     details: dict[str, list[DialoguePicDetails]]
 
-    def __init__(self, directory: str) -> None:
+    cache: pathlib.Path | None
+
+    _script_names: dict[tuple[str, int], str | None]
+
+    def __init__(self, directory: str, cache: str | None = None) -> None:
         self.directory = utils.check_directory(directory)
+        self.cache = None if cache is None else pathlib.Path(cache)
         self.resource_files = list(self.directory.glob('*prefab*.ab'))
-        prefabs = [str(path) for path in self.resource_files]
-        self.details = self.load_prefabs(prefabs)
-
-    def _collect_dialogue_pic_holders(self, prefabs: list[str]):
-        ids: dict[int, bool] = {}
-        for prefab in prefabs:
-            for obj in UnityPy.load(prefab).objects:
-                if obj.type.name != 'MonoBehaviour':
-                    continue
-                data = typing.cast(MonoBehaviour, obj.read())
-                try:
-                    script: MonoScript = data.m_Script.read()
-                    if script.name == 'DialoguePicHolder':
-                        assert obj.path_id not in ids
-                        assert data.m_GameObject.file_id == 0
-                        ids[obj.path_id] = True
-                        yield data
-                except AssertionError as e:
-                    _warning('something went wrong (%s): %s: %s', prefab, obj.path_id, e)
-                except AttributeError:
-                    pass
+        self._script_names = {}
+        self.details = {}
+
+    def extract(self):
+        self.details = self.load_prefabs([str(path) for path in self.resource_files])
+        return self.details
+
+    def _script_name(self, obj: ObjectReader) -> str | None:
+        """
+        Resolves the script name of a MonoBehaviour by reading only its header.
+
+        Script names are cached by the path_id of the MonoScript,
+        so most behaviours are rejected without deserializing anything.
+        """
+        # MonoBehaviour header: (Object, EditorExtension,) Component.m_GameObject, Behaviour.m_Enabled, m_Script
+        obj.reset()
+        if obj.platform == BuildTarget.NoTarget:
+            obj.read_u_int()
+            PPtr(obj)
+            PPtr(obj)
+        PPtr(obj)
+        obj.read_byte()
+        obj.align_stream()
+        script = PPtr(obj)
+        key = (script.external_name or obj.assets_file.name, script.path_id)
+        if key not in self._script_names:
+            script_obj = script.get_obj()
+            name = None
+            if script_obj is not None and script_obj.type.name == 'MonoScript':
+                name = typing.cast(MonoScript, script_obj.read()).name
+            self._script_names[key] = name
+        return self._script_names[key]
 
     @classmethod
     def _match_container_path(cls, path: str) -> str | None:
         match = _path_regex.match(path)
         return None if match is None else match.group(1)
 
-    def _collect_game_objects(self, prefabs: list[str]):
+    def _scan_prefab(self, prefab: str):
+        """
+        Collects game object names and dialogue pic holders from a prefab bundle in a single load.
+        """
+        index = utils.ContainerIndex.load(prefab, 'characters')
         objects: dict[int, str] = {}
-        for prefab in prefabs:
-            for path, obj in UnityPy.load(prefab).container.items():
-                if obj.type.name == 'GameObject' and self._match_container_path(path) is not None:
-                    data = typing.cast(GameObject, obj.read())
-                    if data.name is not None and data.name != '':
-                        objects[data.path_id] = data.name
-        return objects
+        for path, obj in index.prefix(_path_prefix):
+            if obj.type.name == 'GameObject' and self._match_container_path(path) is not None:
+                data = typing.cast(GameObject, obj.read())
+                if data.name is not None and data.name != '':
+                    objects[data.path_id] = data.name
+        holders: list[MonoBehaviour] = []
+        for obj in index.env.objects:
+            if obj.type.name != 'MonoBehaviour':
+                continue
+            if self._script_name(obj) != 'DialoguePicHolder':
+                continue
+            data = typing.cast(MonoBehaviour, obj.read())
+            try:
+                assert data.m_GameObject.file_id == 0
+                holders.append(data)
+            except AssertionError as e:
+                _warning('something went wrong (%s): %s: %s', prefab, obj.path_id, e)
+        return objects, holders
 
     @classmethod
     def _collect_pic_details(cls, name: str, pic: MonoBehaviour):
@@ -111,10 +152,11 @@ class Prefabs:
             ))
         return details
 
-    def load_prefabs(self, prefabs: list[str]):
-        object_names = self._collect_game_objects(prefabs)
+    def _load_bundle_details(self, prefab: str):
         details: dict[str, list[DialoguePicDetails]] = {}
-        for pic in self._collect_dialogue_pic_holders(prefabs):
+        with trace.span(pathlib.Path(prefab).stem, 'bundle'):
+            object_names, holders = self._scan_prefab(prefab)
+        for pic in holders:
             parent_id = pic.m_GameObject.path_id
             if parent_id in object_names:
                 name = object_names[parent_id]
@@ -132,3 +174,54 @@ class Prefabs:
                 if pic_details is not None:
                     details[name] = pic_details
         return details
+
+    def _read_cache(self) -> dict[str, dict[str, typing.Any]]:
+        if self.cache is None or not self.cache.is_file():
+            return {}
+        try:
+            with self.cache.open() as f:
+                cached = json.load(f)
+        except ValueError as e:
+            _warning('ignoring broken prefab cache %s: %s', self.cache, e)
+            return {}
+        if not isinstance(cached, dict) or cached.get('version') != cache_version:
+            _warning('ignoring prefab cache %s of another version', self.cache)
+            return {}
+        return cached['bundles']
+
+    def _write_cache(self, cached: dict[str, dict[str, typing.Any]]):
+        if self.cache is None:
+            return
+        tmp = self.cache.with_suffix('.tmp')
+        with tmp.open('w') as f:
+            f.write(json.dumps({'version': cache_version, 'bundles': cached}, ensure_ascii=False))
+        os.replace(tmp, self.cache)
+
+    def load_prefabs(self, prefabs: list[str]):
+        cached = self._read_cache()
+        updated: dict[str, dict[str, typing.Any]] = {}
+        changed = cached.keys() != set(pathlib.Path(prefab).name for prefab in prefabs)
+        details: dict[str, list[DialoguePicDetails]] = {}
+        for prefab in prefabs:
+            path = pathlib.Path(prefab)
+            fingerprint = utils.fingerprint(path)
+            entry = cached.get(path.name)
+            if entry is not None and entry['fingerprint'] == fingerprint:
+                bundle_details = dict(
+                    (name, [DialoguePicDetails.from_dict(d) for d in items])
+                    for name, items in entry['details'].items()
+                )
+            else:
+                bundle_details = self._load_bundle_details(prefab)
+                changed = True
+            updated[path.name] = {
+                'fingerprint': fingerprint,
+                'details': dict(
+                    (name, [dataclasses.asdict(d) for d in items])
+                    for name, items in bundle_details.items()
+                ),
+            }
+            details.update(bundle_details)
+        if changed:
+            self._write_cache(updated)
+        return details
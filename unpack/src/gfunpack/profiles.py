@@ -0,0 +1,81 @@
+import dataclasses
+import json
+import logging
+import os
+import pathlib
+import typing
+
+_logger = logging.getLogger('gfunpack.profiles')
+_info = _logger.info
+
+stamp_file = '.profile.json'
+
+
+@dataclasses.dataclass(frozen=True)
+class Profile:
+    """
+    Encoder settings of a build, trading compression for speed.
+    """
+
+    name: str
+
+    effort: int
+    """Image encoder effort, from 0 (fastest) to 9 (smallest files)."""
+
+    pngquant: bool
+
+    image_format: str
+    """Image format unless `--image-format` is given."""
+
+    audio: tuple[str, ...]
+    """ffmpeg options for encoding the m4a files."""
+
+    def settings(self, stage: str) -> dict[str, typing.Any]:
+        """
+        The settings the outputs of `stage` depend on.
+        """
+        if stage == 'audio':
+            return {'audio': list(self.audio)}
+        return {'effort': self.effort, 'pngquant': self.pngquant}
+
+
+profiles = {
+    'dev': Profile('dev', effort=1, pngquant=False, image_format='png', audio=('-aac_coder', 'fast', '-b:a', '96k')),
+    'release': Profile('release', effort=9, pngquant=True, image_format='png', audio=('-b:a', '128k')),
+}
+
+default_profile = 'release'
+
+
+class Stamps:
+    """
+    The profile each stage last encoded its outputs with, kept in `.profile.json` of the output directory.
+
+    Outputs without a stamp predate profiles and are taken as they are.
+    """
+
+    path: pathlib.Path
+
+    stages: dict[str, dict[str, typing.Any]]
+
+    def __init__(self, root: pathlib.Path | str) -> None:
+        self.path = pathlib.Path(root).joinpath(stamp_file)
+        self.stages = {}
+        if self.path.is_file():
+            with self.path.open() as f:
+                self.stages = json.load(f)
+
+    def outdated(self, stage: str, profile: Profile):
+        stamp = self.stages.get(stage)
+        if stamp is None or stamp == {'profile': profile.name, **profile.settings(stage)}:
+            return False
+        _info('%s were encoded with the %s profile, encoding them again with %s', stage, stamp['profile'], profile.name)
+        return True
+
+    def stamp(self, stage: str, profile: Profile):
+        self.stages[stage] = {'profile': profile.name, **profile.settings(stage)}
+        tmp = self.path.with_name(f'.{self.path.name}.tmp')
+        with tmp.open('w') as f:
+            f.write(json.dumps(self.stages, indent=2))
+        os.replace(tmp, self.path)
+        return self.path
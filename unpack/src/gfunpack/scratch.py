@@ -0,0 +1,161 @@
+import contextlib
+import itertools
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+
+_logger = logging.getLogger('gfunpack.scratch')
+_info = _logger.info
+_warning = _logger.warning
+
+_ram_directories = ('/dev/shm',)
+
+
+def default_base():
+    """
+    A RAM-backed directory when there is a writable one, the system temporary directory otherwise.
+    """
+    for directory in _ram_directories:
+        if os.path.isdir(directory) and os.access(directory, os.W_OK | os.X_OK):
+            return pathlib.Path(directory)
+    return pathlib.Path(tempfile.gettempdir())
+
+
+def commit(tmp: pathlib.Path, destination: pathlib.Path):
+    """
+    Moves a finished file to its destination atomically, also across file systems.
+    """
+    try:
+        os.replace(tmp, destination)
+    except OSError:
+        # on another file system: copy next to the destination first so that it only ever sees whole files
+        staging = destination.with_name(f'.{destination.name}.tmp')
+        shutil.copyfile(tmp, staging)
+        os.replace(staging, destination)
+        tmp.unlink()
+    return destination
+
+
+class Scratch:
+    """
+    A private directory for intermediate files, kept off the output volume.
+
+    Users reserve the bytes they expect to write; reservations block while the budget is used up.
+    Reservations larger than the whole budget go to an overflow directory in the system temporary directory instead.
+    """
+
+    root: pathlib.Path
+
+    budget: int
+
+    overflow: pathlib.Path | None
+    """On-disk directory for oversized reservations, created on first use."""
+
+    _used: int
+
+    _counter: itertools.count
+
+    _condition: threading.Condition
+
+    def __init__(self, base: pathlib.Path | str | None = None, budget: int | None = None) -> None:
+        base = default_base() if base is None else pathlib.Path(base)
+        base.mkdir(parents=True, exist_ok=True)
+        self.root = pathlib.Path(tempfile.mkdtemp(prefix='gfunpack-', dir=base))
+        if budget is None:
+            # leave room for everybody else on shared memory
+            budget = shutil.disk_usage(self.root).free // 2
+        self.budget = budget
+        self.overflow = None
+        self._used = 0
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        _info('scratch directory: %s (%d MiB)', self.root, self.budget // (1024 * 1024))
+
+    def path(self, name: str, root: pathlib.Path | None = None):
+        """
+        A fresh path in the scratch directory (or `root`), keeping the suffix of `name` for tools that look at it.
+        """
+        return (self.root if root is None else root).joinpath(f'{next(self._counter)}-{name}')
+
+    def directory(self, name: str, root: pathlib.Path | None = None):
+        path = self.path(name, root)
+        path.mkdir()
+        return path
+
+    def _overflow(self):
+        with self._condition:
+            if self.overflow is None:
+                self.overflow = pathlib.Path(tempfile.mkdtemp(prefix='gfunpack-'))
+            return self.overflow
+
+    @contextlib.contextmanager
+    def reserve(self, size: int):
+        """
+        Reserves `size` bytes and yields the directory to write them to.
+        """
+        if size > self.budget:
+            # waiting would never end, and clamping the size would overcommit the scratch area
+            overflow = self._overflow()
+            _warning('%d MiB do not fit in the scratch area, using %s', size // (1024 * 1024), overflow)
+            yield overflow
+            return
+        with self._condition:
+            self._condition.wait_for(lambda: self._used + size <= self.budget)
+            self._used += size
+        try:
+            yield self.root
+        finally:
+            with self._condition:
+                self._used -= size
+                self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def files(self, *names: str, size: int = 0):
+        """
+        Reserves `size` bytes and yields fresh scratch paths for `names`, removing them afterwards.
+        """
+        with self.reserve(size) as root:
+            paths = [self.path(name, root) for name in names]
+            try:
+                yield paths
+            finally:
+                for path in paths:
+                    path.unlink(missing_ok=True)
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        if self.overflow is not None:
+            shutil.rmtree(self.overflow, ignore_errors=True)
+
+
+_scratch: Scratch | None = None
+
+_lock = threading.Lock()
+
+
+def configure(base: pathlib.Path | str | None = None, budget: int | None = None):
+    global _scratch
+    with _lock:
+        if _scratch is not None:
+            _scratch.close()
+        _scratch = Scratch(base, budget)
+        return _scratch
+
+
+def get():
+    global _scratch
+    with _lock:
+        if _scratch is None:
+            _scratch = Scratch()
+        return _scratch
+
+
+def close():
+    global _scratch
+    with _lock:
+        if _scratch is not None:
+            _scratch.close()
+            _scratch = None
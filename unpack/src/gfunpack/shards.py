@@ -0,0 +1,217 @@
+import dataclasses
+import filecmp
+import json
+import logging
+import os
+import pathlib
+import shutil
+import typing
+import zlib
+
+_logger = logging.getLogger('gfunpack.shards')
+_info = _logger.info
+_warning = _logger.warning
+
+shard_file = 'shard.json'
+
+index_files = {
+    'images/backgrounds.json',
+    'images/backgrounds.details.json',
+    'images/characters.json',
+    'images/crops.json',
+    'audio/audio.json',
+}
+"""Partial indexes of each shard, merged instead of copied."""
+
+merged_directories = ('images', 'audio')
+"""Directories copied as they are. Shards write their stories untranspiled, see `raw_scripts`."""
+
+
+@dataclasses.dataclass(frozen=True, order=True)
+class Shard:
+    """
+    One of `count` disjoint parts of the work, picked by the CRC32 of bundle, character and story names.
+
+    The partition only depends on the names, so shards can run on separate hosts sharing nothing but the input.
+    """
+
+    index: int
+
+    count: int
+
+    @classmethod
+    def parse(cls, spec: str):
+        """
+        Parses `I/N` (shard `I` of `N`, counting from 0).
+        """
+        try:
+            index, count = (int(part) for part in spec.split('/'))
+        except ValueError:
+            raise ValueError(f'invalid shard {spec}, expected I/N')
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f'invalid shard {spec}, expected 0 <= I < N')
+        return cls(index, count)
+
+    def owns(self, name: str):
+        return zlib.crc32(name.encode()) % self.count == self.index
+
+    def save(self, destination: pathlib.Path):
+        path = destination.joinpath(shard_file)
+        with path.open('w') as f:
+            f.write(json.dumps(dataclasses.asdict(self)))
+        return path
+
+    @classmethod
+    def load(cls, directory: pathlib.Path):
+        path = directory.joinpath(shard_file)
+        if not path.is_file():
+            raise ValueError(f'{directory} is not the output of a shard')
+        with path.open() as f:
+            return cls(**json.load(f))
+
+    def __str__(self) -> str:
+        return f'{self.index}/{self.count}'
+
+
+def _read(path: pathlib.Path) -> dict[str, typing.Any] | None:
+    if not path.is_file():
+        return None
+    with path.open() as f:
+        return json.load(f)
+
+
+def _write(path: pathlib.Path, data: dict[str, typing.Any], indent: int | None = 2):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open('w') as f:
+        f.write(json.dumps(data, indent=indent, ensure_ascii=False))
+    return path
+
+
+def _link(source: pathlib.Path, target: pathlib.Path):
+    if target.is_file():
+        if not filecmp.cmp(source, target, shallow=False):
+            _warning('conflicting %s, keeping the one from the first shard', target)
+        return False
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f'.{target.name}.tmp')
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, target)
+    return True
+
+
+def _copy_files(part: pathlib.Path, destination: pathlib.Path):
+    copied = 0
+    for directory in merged_directories:
+        for file in part.joinpath(directory).glob('**/*'):
+            # the pixel digests of each shard only describe its own files
+            if not file.is_file() or file.name.endswith('.tmp') or file.name == '.digests.json':
+                continue
+            rel = file.relative_to(part)
+            if rel.as_posix() in index_files:
+                continue
+            if _link(file, destination.joinpath(rel)):
+                copied += 1
+    return copied
+
+
+def _merge_backgrounds(parts: list[pathlib.Path], destination: pathlib.Path):
+    published: dict[int, str] = {}
+    details: dict[int, dict[str, typing.Any]] = {}
+    unmatched: list[tuple[str, dict[str, typing.Any] | None]] = []
+    has_details = False
+    for part in parts:
+        part_published = _read(part.joinpath('images', 'backgrounds.json')) or {}
+        part_details = _read(part.joinpath('images', 'backgrounds.details.json'))
+        has_details = has_details or part_details is not None
+        part_details = part_details or {}
+        for k, v in part_published.items():
+            i = int(k)
+            if i < 0:
+                unmatched.append((v, part_details.get(k)))
+            elif published.get(i, '') == '':
+                # every shard lists all backgrounds, with empty paths for the ones other shards hold
+                published[i] = v
+                if k in part_details:
+                    details[i] = part_details[k]
+    missing = [i for i, v in published.items() if v == '']
+    if len(missing) > 0:
+        _warning('%d backgrounds not found: %s', len(missing), missing)
+    merged = dict(sorted(published.items()))
+    seen = set(merged.values())
+    for path, detail in unmatched:
+        if path in seen:
+            continue
+        seen.add(path)
+        key = -len(merged)
+        merged[key] = path
+        if detail is not None:
+            details[key] = detail
+    _write(destination.joinpath('images', 'backgrounds.json'), merged)
+    if has_details:
+        _write(destination.joinpath('images', 'backgrounds.details.json'), dict((k, details[k]) for k in merged if k in details))
+
+
+def _merge_maps(parts: list[pathlib.Path], destination: pathlib.Path, rel: str, depth: int = 1,
+                indent: int | None = 2, sort: bool = False):
+    merged: dict[str, typing.Any] = {}
+    found = False
+    for part in parts:
+        data = _read(part.joinpath(rel))
+        if data is None:
+            continue
+        found = True
+        for k, v in data.items():
+            if depth > 1 and k in merged:
+                merged[k].update(v)
+            elif k not in merged:
+                merged[k] = v
+    if found:
+        _write(destination.joinpath(rel), dict(sorted(merged.items())) if sort else merged, indent)
+    return merged
+
+
+def _load(parts: typing.Iterable[pathlib.Path | str]):
+    shards = sorted((Shard.load(pathlib.Path(part)), pathlib.Path(part)) for part in parts)
+    if len(shards) == 0:
+        raise ValueError('no shards to merge')
+    count = shards[0][0].count
+    indices = [shard.index for shard, _ in shards]
+    if any(shard.count != count for shard, _ in shards) or indices != list(range(count)):
+        raise ValueError(f'incomplete or mismatching shards: {", ".join(str(shard) for shard, _ in shards)}')
+    return shards
+
+
+def raw_scripts(parts: typing.Iterable[pathlib.Path | str]):
+    """
+    The untranspiled story scripts of all shards, as indexed by their `stories/stories.json`.
+    """
+    scripts: dict[str, pathlib.Path] = {}
+    for _, part in _load(parts):
+        directory = part.joinpath('stories')
+        for name, rel in (_read(directory.joinpath('stories.json')) or {}).items():
+            scripts.setdefault(name, directory.joinpath(rel))
+    return scripts
+
+
+def merge(destination: pathlib.Path | str, parts: typing.Iterable[pathlib.Path | str]):
+    """
+    Combines the output trees of all shards into `destination`.
+
+    Files are hard-linked when possible and partial indexes are merged. Stories are left to the caller,
+    which links the scripts from `raw_scripts` against the merged indexes.
+    """
+    destination = pathlib.Path(destination)
+    shards = _load(parts)
+    directories = [part for _, part in shards]
+    destination.mkdir(parents=True, exist_ok=True)
+    for shard, part in shards:
+        _info('shard %s: %d files copied from %s', shard, _copy_files(part, destination), part)
+    _merge_backgrounds(directories, destination)
+    _merge_maps(directories, destination, 'images/characters.json', depth=2)
+    _merge_maps(directories, destination, 'images/crops.json', sort=True)
+    _merge_maps(directories, destination, 'audio/audio.json')
+    _merge_maps(directories, destination, 'manifest.json', sort=True)
+    return destination
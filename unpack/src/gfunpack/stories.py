@@ -1,3 +1,4 @@
+import dataclasses
 import json
 import logging
 import os
@@ -5,14 +6,14 @@ import pathlib
 import re
 import typing
 
-import UnityPy
 from UnityPy.classes import TextAsset
 
-from gfunpack import mapper, utils, manual_chapters
+from gfunpack import mapper, shards, utils, manual_chapters
 
 _logger = logging.getLogger('gfunpack.prefabs')
 _warning = _logger.warning
 
+_text_asset_prefix = 'assets/resources/dabao/avgtxt/'
 _text_asset_regex = re.compile('^assets/resources/dabao/avgtxt/(.+.txt)$')
 
 _speaker_regex = re.compile('<speaker>(.*)</speaker>', re.IGNORECASE)
@@ -78,6 +79,33 @@ _sprite_effects = {
     '隐身': 'stealth',
 }
 
+@dataclasses.dataclass
+class StoryReferences:
+    backgrounds: set[str] = dataclasses.field(default_factory=set)
+    """Keys into `backgrounds.json` used by `<BIN>`."""
+
+    cgs: set[str] = dataclasses.field(default_factory=set)
+    """Keys into `backgrounds.json` used by `<CG>`."""
+
+    sprites: set[tuple[str, int]] = dataclasses.field(default_factory=set)
+    """(lower-cased character name, sprite index) pairs, as looked up in `characters.json`."""
+
+    audio: set[str] = dataclasses.field(default_factory=set)
+    """Audio identifiers used by `<BGM>` and `<SE>`."""
+
+    def update(self, other: 'StoryReferences'):
+        self.backgrounds.update(other.backgrounds)
+        self.cgs.update(other.cgs)
+        self.sprites.update(other.sprites)
+        self.audio.update(other.audio)
+
+    def has_background(self, key: str):
+        return key in self.backgrounds or key in self.cgs
+
+    def has_sprite(self, character: str, sprite: int):
+        return (character.lower(), sprite) in self.sprites
+
+
 class StoryResources:
     audio: dict[str, str]
     backgrounds: dict[str, str]
@@ -99,6 +127,14 @@ class StoryResources:
                 characters[k.lower()] = v
         self.characters = characters
 
+    @classmethod
+    def empty(cls):
+        resources = cls.__new__(cls)
+        resources.audio = {}
+        resources.backgrounds = {}
+        resources.characters = {}
+        return resources
+
 
 class StoryTranspiler:
     external: StoryResources
@@ -200,20 +236,37 @@ class StoryTranspiler:
         self.effect_tags.update(result.keys())
         return result
 
-    def _get_sprite_info(self, character: str, sprite: int):
+    @classmethod
+    def _resolve_sprite(cls, character: str, sprite: int):
         if character in _wrong_sprites:
             if sprite in _wrong_sprites[character]:
-                character, sprite = _wrong_sprites[character][sprite]
+                return _wrong_sprites[character][sprite]
+        return character, sprite
+
+    def _get_sprite_info(self, character: str, sprite: int):
+        character, sprite = self._resolve_sprite(character, sprite)
         c = self.external.characters.get(character.lower())
         if c is not None:
             s = c.get(str(sprite))
             if s is not None:
-                return {
+                info: dict[str, typing.Any] = {
                     'name': str(sprite),
                     'url': f'/images/{s.path}',
                     'scale': -1,
                     'center': (-1, -1),
                 }
+                if s.variants:
+                    info['variants'] = dict((scale, f'/images/{path}') for scale, path in s.variants.items())
+                if s.crop and s.canvas:
+                    # characters.json holds the geometry placing the trimmed image like the original one
+                    info['scale'] = s.scale
+                    info['center'] = list(s.center)
+                    info['crop'] = list(s.crop)
+                    info['canvas'] = list(s.canvas)
+                if s.atlas and s.rect:
+                    info['atlas'] = f'/images/{s.atlas}'
+                    info['rect'] = list(s.rect)
+                return info
         if character != '':
             _warning('sprite %s not found in %s', sprite, character)
         return {
@@ -338,6 +391,34 @@ extern.preloadResources({resource_urls})
         )
         return speaker, sprite_string, remote_string
 
+    def collect_references(self):
+        """
+        Lists resources used by the script, following the parsing rules of `decode` without generating anything.
+        """
+        references = StoryReferences()
+        if self.filename in ['avgplaybackprofiles.txt', 'profiles.txt']:
+            return references
+        for line in self.script.split('\n'):
+            segments = self._split_line(line)
+            if segments is None:
+                continue
+            narrator_string, effect_string, _ = segments
+            effects = self._parse_effects(effect_string)
+            if 'bin' in effects:
+                references.backgrounds.add(effects['bin'])
+            if 'cg' in effects:
+                references.cgs.update(cg.strip() for cg in effects['cg'].split(',') if cg.strip() != '')
+            for tag in ('bgm', 'se', 'se1', 'se2', 'se3'):
+                if effects.get(tag):
+                    references.audio.add(effects[tag])
+            sprites, _ = self._parse_narrators(narrator_string)
+            for character, sprite, _ in sprites:
+                if character == '':
+                    continue
+                character, sprite = self._resolve_sprite(character, sprite)
+                references.sprites.add((character.lower(), sprite))
+        return references
+
     def _parse_va11(self, content: str):
         content, option_string = content.split('<va11>')
         rankings: list[str] = []
@@ -418,6 +499,11 @@ class Stories:
 
     resource_file: pathlib.Path
 
+    resource_root: pathlib.Path
+    """Output tree holding the audio, background and character indexes the stories link to."""
+
+    resources: StoryResources
+
     extracted: dict[str, pathlib.Path]
 
     content_tags: set[str]
@@ -426,23 +512,70 @@ class Stories:
 
     missing_audio: dict[str, set[str]]
 
-    def __init__(self, directory: str, destination: str, *, gf_data_directory: str | None = None, root_destination: str | None = None):
+    shard: shards.Shard | None
+    """Only extract the scripts of this shard, or `None` to extract all of them."""
+
+    raw: bool
+    """Write the scripts untranspiled, for `gfunpack.merge` to link them against the merged indexes."""
+
+    def __init__(self, directory: str, destination: str, *, gf_data_directory: str | None = None, root_destination: str | None = None,
+                 shard: shards.Shard | None = None, raw: bool = False):
         self.directory = utils.check_directory(directory)
-        self.destination = utils.check_directory(destination, create=True)
+        self._setup(destination, gf_data_directory, root_destination)
         self.resource_file = self.directory.joinpath('asset_textavg.ab')
-        root = self.destination.parent if root_destination is None else pathlib.Path(root_destination)
-        self.resources = StoryResources(
-            root.joinpath('audio', 'audio.json'),
-            root.joinpath('images', 'backgrounds.json'),
-            root.joinpath('images', 'characters.json'),
-        )
-        self.gf_data_directory = root.joinpath('gf-data-ch') if gf_data_directory is None else pathlib.Path(gf_data_directory)
+        self.shard = shard
+        self.raw = raw
+
+    def _setup(self, destination: str, gf_data_directory: str | None, root_destination: str | None = None):
+        self.destination = utils.check_directory(destination, create=True)
+        self.resource_root = self.destination.parent if root_destination is None else pathlib.Path(root_destination)
+        self.resources = StoryResources.empty()
+        self.gf_data_directory = (self.resource_root.joinpath('gf-data-ch') if gf_data_directory is None
+                                  else pathlib.Path(gf_data_directory))
         self.content_tags = set()
         self.effect_tags = set()
         self.missing_audio = { 'bgm': set(), 'se': set() }
+        self.shard = None
+        self.raw = False
+        self.extracted = {}
+
+    def _load_resources(self):
+        # the indexes are read only now so that they can be regenerated after construction
+        self.resources = StoryResources(
+            self.resource_root.joinpath('audio', 'audio.json'),
+            self.resource_root.joinpath('images', 'backgrounds.json'),
+            self.resource_root.joinpath('images', 'characters.json'),
+        )
+
+    def extract(self):
+        if not self.raw:
+            self._load_resources()
         self.extracted = self.extract_all()
         self.copy_missing_pieces()
-        _warning('missing audio: %s', self.missing_audio)
+        if not self.raw:
+            _warning('missing audio: %s', self.missing_audio)
+        return self.extracted
+
+    @classmethod
+    def link(cls, destination: str, scripts: dict[str, pathlib.Path], gf_data_directory: str | None = None):
+        """
+        Transpiles the raw scripts of shards (see `raw`) against the indexes next to `destination`.
+        """
+        stories = cls.__new__(cls)
+        stories._setup(destination, gf_data_directory)
+        stories._load_resources()
+        for name, file in scripts.items():
+            with file.open() as f:
+                stories.extracted[name] = stories._write(name, f.read())
+        _warning('missing audio: %s', stories.missing_audio)
+        return stories
+
+    def _write(self, name: str, content: str):
+        path = self.destination.joinpath(*name.split('/'))
+        os.makedirs(path.parent, exist_ok=True)
+        with path.open('w') as f:
+            f.write(content if self.raw else (self._decode(content, name) or ''))
+        return path
 
     def _decode(self, content: str, filename: str):
         transpiler = StoryTranspiler(self.resources, script=content, filename=filename)
@@ -454,48 +587,85 @@ class Stories:
                 self.missing_audio[k].update(v)
         return chunk
 
+    @classmethod
+    def load(cls, destination: str, gf_data_directory: str):
+        """
+        Stories extracted earlier into `destination`, as indexed by its `stories.json`.
+        """
+        stories = cls.__new__(cls)
+        stories.destination = utils.check_directory(destination)
+        stories.gf_data_directory = pathlib.Path(gf_data_directory)
+        with stories.destination.joinpath('stories.json').open() as f:
+            stories.extracted = dict((k, stories.destination.joinpath(v)) for k, v in json.load(f).items())
+        return stories
+
+    def owns(self, name: str):
+        return self.shard is None or self.shard.owns(name)
+
     def extract_all(self):
-        assets = UnityPy.load(str(self.resource_file))
         extracted: dict[str, pathlib.Path] = {}
-        for o in assets.objects:
-            if o.container is None or o.type.name != 'TextAsset':
+        for name, content in _read_bundle_scripts(self.resource_file):
+            if not self.owns(name):
                 continue
-            match = _text_asset_regex.match(o.container)
-            if match is None:
-                continue
-            name = match.group(1)
-            text = typing.cast(
-                TextAsset,
-                o.read(),
-            )
-            content: str = text.m_Script.tobytes().decode()
-            path = self.destination.joinpath(*name.split('/'))
-            os.makedirs(path.parent, exist_ok=True)
-            with path.open('w') as f:
-                f.write(self._decode(content, name) or '')
-            extracted[name] = path
+            extracted[name] = self._write(name, content)
         return extracted
 
     def copy_missing_pieces(self):
-        manual_chapters.get_extra_stories(self.gf_data_directory.joinpath('asset', 'avgtxt'))
-        manual_chapters.get_extra_anniversary_stories(self.gf_data_directory.joinpath('asset', 'avgtxt'))
-        directory = utils.check_directory(self.gf_data_directory.joinpath('asset', 'avgtxt'))
+        directory = _extra_scripts_directory(self.gf_data_directory)
         for file in directory.glob('**/*.txt'):
             rel = file.relative_to(directory)
             name = str(rel)
-            if name not in self.extracted:
+            if name not in self.extracted and self.owns(name):
                 _warning('filling in %s', name)
-                path = self.destination.joinpath(rel)
-                path.parent.mkdir(exist_ok=True)
-                with path.open('w') as f:
-                    with file.open() as content:
-                        f.write(self._decode(content.read(), name) or '')
-                self.extracted[name] = path
+                with file.open() as content:
+                    self.extracted[name] = self._write(name, content.read())
 
     def save(self):
+        # stories are not content-hashed: chapters.json and the viewer refer to them by their logical names
         path = self.destination.joinpath('stories.json')
         with path.open('w') as f:
             f.write(json.dumps(
                 dict((k, str(p.relative_to(self.destination))) for k, p in self.extracted.items()),
                 ensure_ascii=False,
             ))
+
+
+def _read_bundle_scripts(resource_file: pathlib.Path):
+    index = utils.ContainerIndex.load(resource_file, 'stories')
+    for container, o in index.prefix(_text_asset_prefix):
+        if o.type.name != 'TextAsset':
+            continue
+        match = _text_asset_regex.match(container)
+        if match is None:
+            continue
+        text = typing.cast(
+            TextAsset,
+            o.read(),
+        )
+        content: str = text.m_Script.tobytes().decode()
+        yield match.group(1), content
+
+
+def _extra_scripts_directory(gf_data_directory: pathlib.Path):
+    manual_chapters.get_extra_stories(gf_data_directory.joinpath('asset', 'avgtxt'))
+    manual_chapters.get_extra_anniversary_stories(gf_data_directory.joinpath('asset', 'avgtxt'))
+    return utils.check_directory(gf_data_directory.joinpath('asset', 'avgtxt'))
+
+
+def collect_references(directory: str, gf_data_directory: str):
+    """
+    Scans every story script (including the ones `Stories` fills in) for the resources they use.
+    """
+    resource_file = utils.check_directory(directory).joinpath('asset_textavg.ab')
+    resources = StoryResources.empty()
+    references = StoryReferences()
+    scripts = dict(_read_bundle_scripts(resource_file))
+    extra_directory = _extra_scripts_directory(pathlib.Path(gf_data_directory))
+    for file in extra_directory.glob('**/*.txt'):
+        name = str(file.relative_to(extra_directory))
+        if name not in scripts:
+            with file.open() as content:
+                scripts[name] = content.read()
+    for name, content in scripts.items():
+        references.update(StoryTranspiler(resources, content, name).collect_references())
+    return references
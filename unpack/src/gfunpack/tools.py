@@ -0,0 +1,185 @@
+import asyncio
+import collections
+import concurrent.futures
+import dataclasses
+import logging
+import pathlib
+import subprocess
+import threading
+import time
+import typing
+
+from gfunpack import governor, trace
+
+_logger = logging.getLogger('gfunpack.tools')
+_info = _logger.info
+_warning = _logger.warning
+
+THREADS = object()
+"""Placeholder in tool arguments for the number of threads the tool may use."""
+
+
+@dataclasses.dataclass
+class Timing:
+    tool: str
+    seconds: float
+    returncode: int | None
+    """`None` for invocations that timed out or were cancelled."""
+
+
+class ToolRunner:
+    """
+    Runs external tools as asyncio subprocesses, all driven by one event loop in a background thread.
+
+    Callers either block on `run` or collect the futures of `submit`. Child processes also wait for
+    CPU slots of the governor; stderr is captured and logged for failed invocations.
+    """
+
+    limit: int
+    """Maximum number of child processes in flight."""
+
+    timeout: float | None
+    """Default timeout per invocation in seconds."""
+
+    timings: list[Timing]
+
+    _loop: asyncio.AbstractEventLoop | None
+
+    _thread: threading.Thread | None
+
+    _semaphore: asyncio.Semaphore | None
+
+    _pending: set[concurrent.futures.Future]
+
+    _lock: threading.Lock
+
+    def __init__(self, limit: int = 256, timeout: float | None = None) -> None:
+        self.limit = limit
+        self.timeout = timeout
+        self.timings = []
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=loop.run_forever, name='tools', daemon=True)
+                self._thread.start()
+                self._loop = loop
+            return self._loop
+
+    async def _run(self, args: list[typing.Any], stage: str, slots: int, stdout: int | None,
+                   text: bool, timeout: float | None) -> subprocess.CompletedProcess:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        tool = pathlib.Path(str(args[0])).name
+        async with self._semaphore, governor.get().cpu_async(stage, slots) as threads:
+            command = [str(threads) if arg is THREADS else str(arg) for arg in args]
+            start = time.perf_counter()
+            returncode = None
+            with trace.span(tool, 'subprocess', args=' '.join(command)):
+                process = await asyncio.create_subprocess_exec(
+                    *command,
+                    stdout=stdout,
+                    stderr=subprocess.PIPE,
+                    env=governor.Governor.environ(threads),
+                )
+                try:
+                    out, err = await asyncio.wait_for(process.communicate(), timeout)
+                    returncode = process.returncode
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+                    _warning('%s timed out after %ss: %s', tool, timeout, ' '.join(command))
+                    raise subprocess.TimeoutExpired(command, typing.cast(float, timeout))
+                except asyncio.CancelledError:
+                    process.kill()
+                    await process.wait()
+                    raise
+                finally:
+                    self.timings.append(Timing(tool, time.perf_counter() - start, returncode))
+        stderr = err.decode(errors='replace')
+        if returncode != 0:
+            _warning('%s exited with %s: %s\n%s', tool, returncode, ' '.join(command), stderr.strip())
+        output = out if out is None or not text else out.decode()
+        return subprocess.CompletedProcess(command, typing.cast(int, returncode), output, stderr)
+
+    def submit(self, args: typing.Sequence[typing.Any], stage: str, slots: int = 1, stdout: int | None = None,
+               text: bool = False, timeout: float | None = None) -> 'concurrent.futures.Future[subprocess.CompletedProcess]':
+        loop = self._ensure_loop()
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(list(args), stage, slots, stdout, text, self.timeout if timeout is None else timeout),
+            loop,
+        )
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: concurrent.futures.Future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def run(self, args: typing.Sequence[typing.Any], stage: str, slots: int = 1, stdout: int | None = None,
+            text: bool = False, timeout: float | None = None) -> subprocess.CompletedProcess:
+        return self.submit(args, stage, slots, stdout, text, timeout).result()
+
+    def check_output(self, args: typing.Sequence[typing.Any], stage: str, slots: int = 1, text: bool = False,
+                     timeout: float | None = None):
+        result = self.run(args, stage, slots, subprocess.PIPE, text, timeout)
+        result.check_returncode()
+        return result.stdout
+
+    def cancel(self):
+        """
+        Cancels all pending invocations, killing the processes already started.
+        """
+        with self._lock:
+            pending = list(self._pending)
+        for future in pending:
+            future.cancel()
+        return len(pending)
+
+    def summary(self):
+        totals: dict[str, list[float]] = collections.defaultdict(list)
+        failures: dict[str, int] = collections.defaultdict(int)
+        for timing in list(self.timings):
+            totals[timing.tool].append(timing.seconds)
+            if timing.returncode != 0:
+                failures[timing.tool] += 1
+        for tool, seconds in sorted(totals.items()):
+            _info('%s: %d runs, %.1fs total, %.2fs max, %d failed',
+                  tool, len(seconds), sum(seconds), max(seconds), failures[tool])
+        return totals
+
+
+_runner = ToolRunner()
+
+
+def configure(limit: int = 256, timeout: float | None = None):
+    global _runner
+    _runner = ToolRunner(limit, timeout)
+    return _runner
+
+
+def get():
+    return _runner
+
+
+def submit(args: typing.Sequence[typing.Any], stage: str, slots: int = 1, stdout: int | None = None,
+           text: bool = False, timeout: float | None = None):
+    return _runner.submit(args, stage, slots, stdout, text, timeout)
+
+
+def run(args: typing.Sequence[typing.Any], stage: str, slots: int = 1, stdout: int | None = None,
+        text: bool = False, timeout: float | None = None):
+    return _runner.run(args, stage, slots, stdout, text, timeout)
+
+
+def check_output(args: typing.Sequence[typing.Any], stage: str, slots: int = 1, text: bool = False,
+                 timeout: float | None = None):
+    return _runner.check_output(args, stage, slots, text, timeout)
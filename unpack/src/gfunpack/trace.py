@@ -0,0 +1,106 @@
+import contextlib
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+import typing
+
+_logger = logging.getLogger('gfunpack.trace')
+_info = _logger.info
+
+
+class Tracer:
+    """
+    Collects spans in the Trace Event Format (as understood by `chrome://tracing` and Perfetto).
+    """
+
+    path: pathlib.Path
+
+    events: list[dict[str, typing.Any]]
+
+    _threads: set[int]
+
+    _lock: threading.Lock
+
+    _start: int
+
+    def __init__(self, path: pathlib.Path | str) -> None:
+        self.path = pathlib.Path(path)
+        self.events = []
+        self._threads = set()
+        self._lock = threading.Lock()
+        self._start = time.perf_counter_ns()
+
+    def now(self) -> float:
+        return (time.perf_counter_ns() - self._start) / 1000
+
+    def complete(self, name: str, category: str, start: float, end: float, args: dict[str, typing.Any]):
+        thread = threading.current_thread()
+        tid = threading.get_ident()
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': start,
+            'dur': end - start,
+            'pid': os.getpid(),
+            'tid': tid,
+            'args': args,
+        }
+        with self._lock:
+            if tid not in self._threads:
+                self._threads.add(tid)
+                self.events.append({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': os.getpid(),
+                    'tid': tid,
+                    'args': {'name': thread.name},
+                })
+            self.events.append(event)
+
+    def save(self):
+        with self._lock:
+            data = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+        with self.path.open('w') as f:
+            f.write(json.dumps(data, ensure_ascii=False))
+        _info('trace written to %s (%d events)', self.path, len(data['traceEvents']))
+        return self.path
+
+
+_tracer: Tracer | None = None
+
+
+def enable(path: pathlib.Path | str):
+    global _tracer
+    _tracer = Tracer(path)
+    return _tracer
+
+
+def enabled():
+    return _tracer is not None
+
+
+def save():
+    if _tracer is not None:
+        return _tracer.save()
+    return None
+
+
+@contextlib.contextmanager
+def span(name: str, category: str, **args: typing.Any):
+    """
+    Records the enclosed block as a complete event; a no-op unless tracing is enabled.
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+    start = tracer.now()
+    try:
+        yield
+    finally:
+        tracer.complete(name, category, start, tracer.now(), dict((k, str(v)) for k, v in args.items()))
+
@@ -1,15 +1,34 @@
+import bisect
 import logging
+import mmap
 import os
 import pathlib
 import subprocess
 import typing
 
 import UnityPy
+from UnityPy import Environment
 from UnityPy.classes import TextAsset
+from UnityPy.files import ObjectReader, SerializedFile
+
+from gfunpack import governor, scratch, tools, trace
+
+if typing.TYPE_CHECKING:
+    from gfunpack import cache
 
 _logger = logging.getLogger('gfunpack.utils')
 _warning = _logger.warning
 
+_bundle_cache: 'cache.BundleCache | None' = None
+
+
+def use_bundle_cache(bundle_cache: 'cache.BundleCache | None'):
+    """
+    Makes `load_bundle` read decompressed copies of bundles from the cache (and populate it).
+    """
+    global _bundle_cache
+    _bundle_cache = bundle_cache
+
 
 def check_directory(directory: pathlib.Path | str, create: bool = False) -> pathlib.Path:
     d = pathlib.Path(directory)
@@ -20,6 +39,14 @@ def check_directory(directory: pathlib.Path | str, create: bool = False) -> path
     return d.resolve()
 
 
+def fingerprint(file: pathlib.Path) -> str:
+    """
+    A cheap identity of a file's content, changing whenever the file is replaced or modified.
+    """
+    stat = file.stat()
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+
 def test_pngquant(use_pngquant: bool):
     if not use_pngquant:
         return False
@@ -32,18 +59,113 @@ def test_pngquant(use_pngquant: bool):
             return False
 
 
-def pngquant(image_path: pathlib.Path, use_pngquant: bool):
+def pngquant(image_path: pathlib.Path, use_pngquant: bool, stage: str = 'images'):
     # pngquant to minimize the image
     if use_pngquant:
-        quant_path = image_path.with_suffix('.fs8.png')
-        subprocess.run(['pngquant', image_path, '--ext', '.fs8.png', '--strip']).check_returncode()
-        os.replace(quant_path, image_path)
+        # the quantized copy is written to the scratch area and moved over the original once complete
+        with scratch.get().files(f'{image_path.stem}.fs8.png') as (quant_path,):
+            tools.run(
+                ['pngquant', '--force', '--strip', '--output', quant_path, image_path], stage,
+            ).check_returncode()
+            scratch.commit(quant_path, image_path)
+
+
+def map_bundle(bundle: pathlib.Path):
+    """
+    Loads a bundle from a read-only memory mapping of the file.
+
+    Pages of the mapping come from the page cache, shared with everyone else reading the same file,
+    instead of being read into a private buffer.
+    """
+    with bundle.open('rb') as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # empty files and file systems without mmap support
+            return UnityPy.load(str(bundle))
+    env = Environment()
+    env.path = str(bundle.parent)
+    # naming the stream keeps UnityPy from hashing the whole buffer for a name
+    env.load_file(memoryview(mapped), name=str(bundle))
+    if len(env.files) == 1:
+        env.file = next(iter(env.files.values()))
+    return env
+
+
+def load_bundle(bundle: pathlib.Path | str, stage: str):
+    bundle = pathlib.Path(bundle)
+    bundle_cache = _bundle_cache
+    with governor.get().io_token(stage), trace.span('UnityPy.load', 'bundle', bundle=bundle.name):
+        if bundle_cache is None:
+            return map_bundle(bundle)
+        cached = bundle_cache.locate(bundle)
+        if cached is not None:
+            return map_bundle(cached)
+        env = map_bundle(bundle)
+    with trace.span('cache', 'bundle', bundle=bundle.name):
+        bundle_cache.store(bundle, env)
+    return env
+
+
+class ContainerIndex:
+    """
+    Container paths of a loaded bundle, indexed once for exact and prefix lookups.
+    """
+
+    env: Environment
+
+    paths: list[str]
+
+    objects: dict[str, list[ObjectReader]]
+
+    def __init__(self, env: Environment) -> None:
+        self.env = env
+        self.objects = {}
+        for assets in self._serialized_files(env):
+            for path, info in assets.container.container:
+                if info.asset.file_id != 0:
+                    continue
+                obj = assets.objects.get(info.asset.path_id)
+                if obj is not None:
+                    self.objects.setdefault(path, []).append(obj)
+        self.paths = sorted(self.objects.keys())
+
+    @classmethod
+    def load(cls, bundle: pathlib.Path | str, stage: str):
+        return cls(load_bundle(bundle, stage))
+
+    @classmethod
+    def _serialized_files(cls, file) -> typing.Iterator[SerializedFile]:
+        for f in getattr(file, 'files', {}).values():
+            if getattr(f, 'is_dependency', False):
+                continue
+            if isinstance(f, SerializedFile):
+                yield f
+            else:
+                yield from cls._serialized_files(f)
+
+    def get(self, path: str) -> list[ObjectReader]:
+        return self.objects.get(path, [])
+
+    def first(self, path: str, type_name: str | None = None):
+        for obj in self.get(path):
+            if type_name is None or obj.type.name == type_name:
+                return obj
+        return None
+
+    def prefix(self, prefix: str) -> typing.Iterator[tuple[str, ObjectReader]]:
+        start = bisect.bisect_left(self.paths, prefix)
+        for path in self.paths[start:]:
+            if not path.startswith(prefix):
+                break
+            for obj in self.objects[path]:
+                yield path, obj
 
 
-def read_text_asset(bundle: pathlib.Path, container: str):
-    asset = UnityPy.load(str(bundle))
-    profile_reader = [o for o in asset.objects if o.container == container][0]
-    assert profile_reader.type.name == 'TextAsset'
+def read_text_asset(bundle: pathlib.Path, container: str, stage: str):
+    profile_reader = ContainerIndex.load(bundle, stage).first(container, 'TextAsset')
+    if profile_reader is None:
+        raise ValueError(f'no TextAsset at {container} in {bundle}')
     profile = typing.cast(
         TextAsset,
         profile_reader.read(),
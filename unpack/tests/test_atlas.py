@@ -0,0 +1,28 @@
+from PIL import Image
+
+from gfunpack import atlas, imaging
+
+
+def test_pack():
+    sizes = [(60, 40), (50, 100), (60, 60), (200, 10)]
+    placed = atlas.pack(sizes, max_size=128, padding=0)
+    assert placed[3] is None
+    assert placed[1] == (0, (0, 0, 50, 100))
+    assert placed[2] == (0, (50, 0, 60, 60))
+    assert placed[0] == (1, (0, 0, 60, 40))
+
+
+def test_character_atlas(tmp_path):
+    members = []
+    for i, size in enumerate([(30, 40), (20, 20)]):
+        member = tmp_path.joinpath(f'pic_{i}.png')
+        Image.new('RGBA', size, (i, 0, 0, 255)).save(member)
+        members.append(member)
+    output = imaging.ImageOutput()
+    character_atlas = atlas.CharacterAtlas(tmp_path, 64)
+    assert character_atlas.build(members, output)
+    packed, rect = character_atlas.rects[members[1]]
+    assert atlas.is_atlas(packed)
+    with Image.open(packed) as image:
+        assert image.crop((rect[0], rect[1], rect[0] + rect[2], rect[1] + rect[3])).getpixel((0, 0)) == (1, 0, 0, 255)
+    assert not atlas.CharacterAtlas(tmp_path, 64).build(members, output)
@@ -2,7 +2,19 @@ from gfunpack import audio
 
 
 def test_bgm():
-    audio.BGM('downloader/output', 'audio')
+    audio.BGM('downloader/output', 'audio').extract()
+
+
+def test_batches(tmp_path):
+    files = []
+    for i, size in enumerate([1, 1, 1, 5, 1]):
+        file = tmp_path.joinpath(f'{i}.ab')
+        file.write_bytes(b'0' * size)
+        files.append(file)
+    batches = list(audio._batches(files, 2, 3 * audio._wav_ratio))
+    # the 5-byte archive exceeds the budget alone and gets a batch of its own
+    assert [len(batch) for batch, _ in batches] == [2, 1, 1, 1]
+    assert [size // audio._wav_ratio for _, size in batches] == [2, 1, 5, 1]
 
 if __name__ == '__main__':
     test_bgm()
@@ -1,10 +1,48 @@
-from gfunpack import backgrounds
+import threading
+import types
+
+from PIL import Image
+
+from gfunpack import backgrounds, imaging
 
 
 def test_backgrounds():
     bg = backgrounds.BackgroundCollection('downloader/output', 'images', pngquant=True)
+    bg.extract()
     bg.save()
 
 
+def _collection(destination):
+    bg = backgrounds.BackgroundCollection.__new__(backgrounds.BackgroundCollection)
+    bg.destination = destination
+    bg.pngquant = False
+    bg.force = False
+    # one writer at a time, so that the first background is the canonical one
+    bg.concurrency = 1
+    bg.output = imaging.ImageOutput()
+    bg.texture_cache = None
+    bg._cg_names = set()
+    bg._deduplicator = imaging.Deduplicator(destination.joinpath('.digests.json'))
+    bg._semaphore = threading.Semaphore(1)
+    return bg
+
+
+def _reader(image):
+    return types.SimpleNamespace(read=lambda: types.SimpleNamespace(image=image, path_id=0))
+
+
+def test_incremental_deduplication(tmp_path):
+    red = Image.new('RGB', (8, 8), (255, 0, 0))
+    resources = {'bg1': _reader(red), 'bg2': _reader(red.copy())}
+    first = _collection(tmp_path)
+    canonical = tmp_path.joinpath('bg1.png')
+    assert first._extract_files(resources, tmp_path) == {'bg1': canonical, 'bg2': canonical}
+    first._deduplicator.save()
+    # bg1.png is kept and not decoded again, the digest still maps bg2 to it
+    second = _collection(tmp_path)
+    assert second._extract_files(resources, tmp_path) == {'bg1': canonical, 'bg2': canonical}
+    assert not tmp_path.joinpath('bg2.png').exists()
+
+
 if __name__ == '__main__':
     test_backgrounds()
@@ -0,0 +1,32 @@
+import os
+
+from PIL import Image
+
+from gfunpack import cache
+
+
+def test_texture_cache(tmp_path):
+    entry_size = cache._texture_header.size + 8 * 8 * 4
+    texture_cache = cache.TextureCache(tmp_path, entry_size * 2)
+    for i in range(3):
+        texture_cache.put(str(i), Image.new('RGBA', (8, 8), (i, 0, 0, 255)))
+        os.utime(texture_cache.entry(str(i)), ns=(i, i))
+        assert texture_cache.size() <= entry_size * 2
+    assert texture_cache.get('0') is None
+    image = texture_cache.get('2')
+    assert image is not None and image.getpixel((0, 0)) == (2, 0, 0, 255)
+    # hits count as uses
+    texture_cache.put('3', Image.new('RGB', (8, 8)))
+    assert texture_cache.get('1') is None
+    assert texture_cache.get('2') is not None
+
+
+def test_texture_cache_modes(tmp_path):
+    texture_cache = cache.TextureCache(tmp_path, 1 << 20)
+    for mode, color in (('RGB', (1, 2, 3)), ('RGBA', (1, 2, 3, 4)), ('L', 5)):
+        image = Image.new(mode, (4, 3), color)
+        texture_cache.put(mode, image)
+        cached = texture_cache.get(mode)
+        # a cache hit gives back the image a cold run decodes, down to the mode
+        assert cached is not None and cached.mode == mode and cached.size == (4, 3)
+        assert cached.tobytes() == image.tobytes()
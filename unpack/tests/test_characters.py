@@ -3,11 +3,24 @@ from gfunpack import characters, prefabs
 
 def test_characters():
     sprite_indices = prefabs.Prefabs('downloader/output')
+    sprite_indices.extract()
     characters.CharacterCollection(
         'downloader/output', 'images',
         sprite_indices, pngquant=True,
     ).extract()
 
 
+def test_drop_unwritten(tmp_path):
+    canonical = tmp_path.joinpath('m4a1', 'pic_m4a1.png')
+    written = tmp_path.joinpath('m16a1', 'pic_m16a1.png')
+    written.parent.mkdir()
+    written.write_bytes(b'png')
+    collection = characters.CharacterCollection.__new__(characters.CharacterCollection)
+    # a canonical image that failed, with a duplicate claimed before it did
+    collection.exported_images = {'M4A1/0': canonical, 'M4A1Mod/0': canonical, 'M16A1/0': written}
+    collection._drop_unwritten()
+    assert collection.exported_images == {'M16A1/0': written}
+
+
 if __name__ == '__main__':
     test_characters()
@@ -0,0 +1,23 @@
+from gfunpack import checkpoint
+
+
+def test_checkpoint(tmp_path):
+    path = tmp_path.joinpath('.checkpoint.json')
+    progress = checkpoint.Checkpoint(path, interval=3600)
+    progress.complete('backgrounds', 'resource_avgtexture1.ab', {'bg': 'background/bg.png'})
+    assert not path.exists()
+    progress.finish('backgrounds')
+    resumed = checkpoint.Checkpoint(path, resume=True)
+    assert resumed.get('backgrounds', 'resource_avgtexture1.ab') == {'bg': 'background/bg.png'}
+    assert resumed.finished == {'backgrounds'}
+    progress = checkpoint.Checkpoint(path, stages=['characters'])
+    progress.complete('characters', 'm4a1/0', {'path': 'm4a1/0.png'})
+    progress.save()
+    # entries of stages that do not run again are kept
+    assert checkpoint.Checkpoint(path, stages=['audio']).done('backgrounds', 'resource_avgtexture1.ab')
+    assert not checkpoint.Checkpoint(path, stages=['backgrounds']).done('backgrounds', 'resource_avgtexture1.ab')
+    assert not checkpoint.Checkpoint(path).done('characters', 'm4a1/0')
+    resumed = checkpoint.Checkpoint(path, resume=True)
+    assert resumed.finished == {'backgrounds'}
+    resumed.clear()
+    assert not path.exists()
@@ -0,0 +1,27 @@
+import threading
+import time
+
+from gfunpack import governor
+
+
+def test_priorities():
+    g = governor.Governor(1)
+    order: list[str] = []
+
+    def work(stage: str):
+        with g.cpu(stage):
+            order.append(stage)
+
+    threads = [threading.Thread(target=work, args=(stage,)) for stage in ('audio', 'characters')]
+    with g.cpu('backgrounds'):
+        for thread in threads:
+            thread.start()
+            time.sleep(0.05)
+    for thread in threads:
+        thread.join()
+    assert order == ['characters', 'audio']
+
+
+def test_environ():
+    env = governor.Governor.environ(2)
+    assert env['OMP_NUM_THREADS'] == '2' and env['MAGICK_THREAD_LIMIT'] == '2'
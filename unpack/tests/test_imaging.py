@@ -0,0 +1,63 @@
+import pytest
+from PIL import Image
+
+from gfunpack import imaging
+
+
+def test_image_output(tmp_path):
+    png = tmp_path.joinpath('sprite.png')
+    Image.new('RGBA', (32, 32), (255, 0, 0, 128)).save(png)
+    output = imaging.ImageOutput('webp', {'sprite': 70})
+    assert output.quality['sprite'] == 70
+    encoded = output.encode(png, 'sprite')
+    assert encoded == tmp_path.joinpath('sprite.webp')
+    with Image.open(encoded) as image:
+        assert image.mode == 'RGBA'
+    assert imaging.ImageOutput().encode(png, 'sprite') == png
+
+
+def test_variants(tmp_path):
+    png = tmp_path.joinpath('background.png')
+    image = Image.new('RGB', (200, 100))
+    image.save(png)
+    output = imaging.ImageOutput('webp', variants=(50, 25))
+    output.encode(png, 'background', image)
+    assert output.is_complete(png)
+    for scale, variant in output.variant_paths(png).items():
+        assert imaging.is_variant(variant)
+        with Image.open(variant) as v:
+            assert v.size == (200 * scale // 100, 100 * scale // 100)
+
+
+def test_effort(tmp_path):
+    image = Image.linear_gradient('L').convert('RGB')
+    sizes = []
+    for effort in (0, 9):
+        path = tmp_path.joinpath(f'{effort}.png')
+        imaging.ImageOutput(effort=effort).save_png(image, path)
+        sizes.append(path.stat().st_size)
+    assert sizes[0] > sizes[1]
+    assert imaging.ImageOutput('webp', effort=0).encode(path, 'background') == path.with_suffix('.webp')
+    with pytest.raises(ValueError):
+        imaging.ImageOutput(effort=10)
+
+
+def test_trim(tmp_path):
+    png = tmp_path.joinpath('sprite.png')
+    image = Image.new('RGBA', (100, 80), (0, 0, 0, 0))
+    image.paste((255, 255, 255, 255), (10, 20, 60, 70))
+    image.save(png)
+    assert imaging.trim(png, imaging.ImageOutput()) == ((10, 20, 60, 70), (100, 80))
+    with Image.open(png) as trimmed:
+        assert trimmed.size == (50, 50)
+    assert imaging.trim(png, imaging.ImageOutput()) is None
+
+
+def test_deduplicator(tmp_path):
+    red = Image.new('RGBA', (8, 8), (255, 0, 0, 255))
+    deduplicator = imaging.Deduplicator()
+    first, second = tmp_path.joinpath('a.png'), tmp_path.joinpath('b.png')
+    assert deduplicator.claim(imaging.pixel_digest(red), first) is None
+    assert deduplicator.claim(imaging.pixel_digest(red.copy()), second) == first
+    assert deduplicator.claim(imaging.pixel_digest(red.convert('RGB')), second) is None
+    assert deduplicator.duplicates == 1
@@ -0,0 +1,53 @@
+import json
+import os
+import pathlib
+import subprocess
+import sys
+
+import pytest
+
+import gfunpack
+
+_heavy_modules = ('UnityPy', 'PIL', 'tqdm', 'hjson')
+
+_script = '''
+import importlib, json, sys
+module = importlib.import_module(sys.argv[1])
+try:
+    module.parser.parse_args(['--help'])
+except SystemExit:
+    pass
+print(json.dumps(sorted(set(name.split('.')[0] for name in sys.modules))))
+'''
+
+
+def _imported(module: str):
+    """
+    Top-level modules loaded by importing `module` and printing its help, in a fresh interpreter.
+    """
+    env = dict(os.environ)
+    source = str(pathlib.Path(list(gfunpack.__path__)[0]).parent)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [source, env.get('PYTHONPATH')]))
+    result = subprocess.run(
+        [sys.executable, '-c', _script, module],
+        capture_output=True, text=True, check=True, env=env,
+    )
+    return set(json.loads(result.stdout.strip().split('\n')[-1]))
+
+
+def test_startup():
+    # --help (and argument errors) should not wait for the dependencies of the stages
+    for module in ('gfunpack.__main__', 'gfunpack.merge'):
+        imported = _imported(module)
+        assert 'gfunpack' in imported
+        assert imported.isdisjoint(_heavy_modules), f'{module} imports {imported & set(_heavy_modules)}'
+
+
+def test_quality(capsys):
+    from gfunpack import __main__
+    args = __main__.parser.parse_args(['in', '-o', 'out', '--quality', 'cg=90', '--quality', 'sprite=70'])
+    assert dict(args.quality) == {'cg': 90, 'sprite': 70}
+    for spec in ('cg', 'cg=high', 'portrait=90', 'cg=101'):
+        with pytest.raises(SystemExit):
+            __main__.parser.parse_args(['in', '-o', 'out', '--quality', spec])
+        assert 'argument --quality' in capsys.readouterr().err
@@ -0,0 +1,44 @@
+import json
+
+from gfunpack import manifest
+
+
+def test_manifest(tmp_path):
+    image = tmp_path.joinpath('images', 'background', 'bg.png')
+    image.parent.mkdir(parents=True)
+    image.write_bytes(b'png')
+    hashed = manifest.Manifest(tmp_path)
+    path = hashed.add(image, tmp_path.joinpath('images'))
+    assert path.read_bytes() == b'png'
+    assert path.parent == tmp_path.joinpath('images', manifest.hashed_directory).resolve()
+    assert image.is_file()
+    assets = json.loads(hashed.save().read_text())
+    assert assets == {'images/background/bg.png': f'images/_hashed/{path.name}'}
+    assert manifest.Manifest(tmp_path).load().assets == assets
+
+
+def test_delta(tmp_path):
+    stories = tmp_path.joinpath('stories')
+    stories.mkdir()
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        stories.joinpath(name).write_text(name)
+    manifest.write_delta(tmp_path)
+    stories.joinpath('a.txt').write_text('changed')
+    stories.joinpath('b.txt').unlink()
+    stories.joinpath('d.txt').write_text('d')
+    delta = json.loads(manifest.write_delta(tmp_path).read_text())
+    assert delta == {
+        'added': ['stories/d.txt'],
+        'changed': ['stories/a.txt'],
+        'removed': ['stories/b.txt'],
+    }
+
+
+def test_index_files(tmp_path):
+    images = tmp_path.joinpath('images')
+    images.joinpath('m4a1').mkdir(parents=True)
+    for name in ('characters.json', 'crops.json', '.digests.json', 'm4a1/.atlas.json', 'm4a1/0.png'):
+        images.joinpath(name).write_text(name)
+    # internal bookkeeping is not published
+    assert sorted(manifest.index_files(tmp_path)) == ['images/characters.json', 'images/m4a1/0.png']
+
@@ -5,14 +5,28 @@ from gfunpack import prefabs
 
 def test_mapper():
     prefab_collection = prefabs.Prefabs('downloader/output')
+    prefab_collection.extract()
     character_collection = characters.CharacterCollection(
         'downloader/output', 'images', prefab_collection,
         pngquant=True, verbose=True,
     )
     character_collection.extract()
     mapping = mapper.Mapper(prefab_collection, character_collection)
+    mapping.map_sprite_path_ids()
     mapping.write_indices()
 
 
+def test_trimmed_offset():
+    # trimming 10px off the left and 20px off the bottom moves the center right and up
+    assert mapper.trimmed_offset((0.0, 0.0), (10, 0, 100, 80), (100, 100)) == (5.0, 10.0)
+    assert mapper.trimmed_offset((1.0, 1.0), (0, 0, 100, 100), (100, 100)) == (1.0, 1.0)
+
+
+def test_trimmed_geometry():
+    # 80px of the 100px canvas, whose center (50, 50) lies at (40, 30) in the trimmed image
+    assert mapper.trimmed_geometry(-1.0, (10, 20, 90, 100), (100, 100)) == (0.8, (40.0, 30.0))
+    assert mapper.trimmed_geometry(0.5, (10, 20, 90, 100), (100, 100)) == (0.4, (40.0, 30.0))
+
+
 if __name__ == '__main__':
     test_mapper()
@@ -6,6 +6,7 @@ from gfunpack import prefabs
 
 def test_collecting_files():
     info = prefabs.Prefabs('downloader/output')
+    info.extract()
     with open('prefabs.json', 'w') as f:
         json.dump(
             dict((k, [dataclasses.asdict(i) for i in v]) for k, v in info.details.items()),
@@ -14,5 +15,18 @@ def test_collecting_files():
         )
 
 
+def test_cache_version(tmp_path):
+    info = prefabs.Prefabs.__new__(prefabs.Prefabs)
+    info.cache = tmp_path.joinpath('prefabs.cache.json')
+    bundles = {'avgpicprefabs.ab': {'fingerprint': [1, 2], 'details': {}}}
+    info._write_cache(bundles)
+    assert info._read_cache() == bundles
+    # caches of another format are ignored instead of misread
+    info.cache.write_text(json.dumps(bundles))
+    assert info._read_cache() == {}
+    info.cache.write_text(json.dumps({'version': prefabs.cache_version + 1, 'bundles': bundles}))
+    assert info._read_cache() == {}
+
+
 if __name__ == '__main__':
     test_collecting_files()
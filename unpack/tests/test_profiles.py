@@ -0,0 +1,19 @@
+from gfunpack import profiles
+
+
+def test_stamps(tmp_path):
+    dev = profiles.profiles['dev']
+    release = profiles.profiles['release']
+    stamps = profiles.Stamps(tmp_path)
+    # outputs from before profiles are kept
+    assert not stamps.outdated('characters', release)
+    stamps.stamp('characters', dev)
+    stamps.stamp('audio', dev)
+    stamps = profiles.Stamps(tmp_path)
+    assert not stamps.outdated('characters', dev)
+    assert stamps.outdated('characters', release)
+    assert stamps.outdated('audio', release)
+    # only the settings of the stage count
+    tweaked = profiles.Profile('dev', dev.effort, dev.pngquant, dev.image_format, ('-b:a', '64k'))
+    assert not stamps.outdated('characters', tweaked)
+    assert stamps.outdated('audio', tweaked)
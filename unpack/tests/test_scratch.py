@@ -0,0 +1,27 @@
+import threading
+
+from gfunpack import scratch
+
+
+def test_scratch(tmp_path):
+    area = scratch.Scratch(tmp_path.joinpath('scratch'), budget=100)
+    destination = tmp_path.joinpath('out.png')
+    with area.files('out.png', size=60) as (path,):
+        assert path.parent == area.root and path.suffix == '.png'
+        path.write_bytes(b'png')
+        scratch.commit(path, destination)
+        waiting = threading.Thread(target=lambda: area.reserve(60).__enter__())
+        waiting.start()
+        waiting.join(0.1)
+        # blocked until the first reservation is released
+        assert waiting.is_alive()
+    waiting.join(1)
+    assert not waiting.is_alive()
+    assert destination.read_bytes() == b'png'
+    with area.files('large.wav', size=1000) as (path,):
+        # larger than the whole budget: goes to disk instead of overcommitting the scratch area
+        assert path.parent == area.overflow and area.overflow != area.root
+        path.write_bytes(b'wav')
+    assert area._used == 0
+    area.close()
+    assert not area.root.exists() and not area.overflow.exists()
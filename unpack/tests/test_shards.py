@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from gfunpack import shards, stories
+
+
+def test_shard():
+    assert shards.Shard.parse('1/3') == shards.Shard(1, 3)
+    with pytest.raises(ValueError):
+        shards.Shard.parse('3/3')
+    names = [f'resource_avgtexture{i}.ab' for i in range(100)]
+    parts = [shards.Shard(i, 3) for i in range(3)]
+    owners = [[shard for shard in parts if shard.owns(name)] for name in names]
+    assert all(len(owner) == 1 for owner in owners)
+    assert all(any(shard.owns(name) for name in names) for shard in parts)
+
+
+def _write_shard(part, shard, backgrounds, characters, audio, scripts={}):
+    part.mkdir()
+    shard.save(part)
+    images = part.joinpath('images')
+    images.joinpath('background').mkdir(parents=True)
+    for path in backgrounds.values():
+        if path != '':
+            images.joinpath(path).write_bytes(path.encode())
+    images.joinpath('backgrounds.json').write_text(json.dumps(backgrounds))
+    images.joinpath('characters.json').write_text(json.dumps(characters))
+    part.joinpath('audio').mkdir()
+    part.joinpath('audio', 'audio.json').write_text(json.dumps(audio))
+    part.joinpath('stories').mkdir()
+    for name, script in scripts.items():
+        part.joinpath('stories', name).write_text(script)
+    part.joinpath('stories', 'stories.json').write_text(json.dumps(dict((name, name) for name in scripts)))
+
+
+def test_merge(tmp_path):
+    first = tmp_path.joinpath('0')
+    second = tmp_path.joinpath('1')
+    _write_shard(
+        first, shards.Shard(0, 2),
+        {'0': 'background/a.png', '1': '', '-2': 'background/x.png'},
+        {'m4': {'0': {'path': 'm4/0.png'}}},
+        {'BGM_A': 'bgm/a.m4a'},
+        # raw scripts link to backgrounds held by other shards
+        {'a.txt': '()||<BIN>1</BIN>: ……'},
+    )
+    _write_shard(
+        second, shards.Shard(1, 2),
+        {'0': '', '1': 'background/b.png', '-2': 'background/y.png'},
+        {'m4': {'1': {'path': 'm4/1.png'}}},
+        {'BGM_B': 'bgm/b.m4a'},
+    )
+    with pytest.raises(ValueError):
+        shards.merge(tmp_path.joinpath('out'), [first])
+    out = shards.merge(tmp_path.joinpath('out'), [second, first])
+    assert json.loads(out.joinpath('images', 'backgrounds.json').read_text()) == {
+        '0': 'background/a.png', '1': 'background/b.png', '-2': 'background/x.png', '-3': 'background/y.png',
+    }
+    assert json.loads(out.joinpath('images', 'characters.json').read_text()) == {
+        'm4': {'0': {'path': 'm4/0.png'}, '1': {'path': 'm4/1.png'}},
+    }
+    assert json.loads(out.joinpath('audio', 'audio.json').read_text()) == {'BGM_A': 'bgm/a.m4a', 'BGM_B': 'bgm/b.m4a'}
+    assert out.joinpath('images', 'background', 'y.png').read_bytes() == b'background/y.png'
+    scripts = shards.raw_scripts([first, second])
+    assert scripts == {'a.txt': first.joinpath('stories', 'a.txt')}
+    ss = stories.Stories.link(str(out.joinpath('stories')), scripts)
+    assert 'background/b.png' in ss.extracted['a.txt'].read_text()
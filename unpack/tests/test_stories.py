@@ -1,13 +1,53 @@
+import json
+
 from gfunpack import chapters, characters, mapper, prefabs, stories
 
 
 def test_stories():
     ss = stories.Stories('downloader/output', 'stories')
+    ss.extract()
     ss.save()
-    chapters.Chapters(ss).save()
+    cs = chapters.Chapters(ss)
+    cs.categorize()
+    cs.save()
     print(ss.content_tags)
     print(ss.effect_tags)
 
 
+def test_references():
+    script = '\n'.join([
+        'M4A1(2)<Speaker>M4A1</Speaker>;G36C(7)||<BIN>12</BIN><BGM>BGM_Theme</BGM>: ……',
+        '()||<CG>3,4,</CG><SE2>SE_Door</SE2>: ……',
+    ])
+    transpiler = stories.StoryTranspiler(stories.StoryResources.empty(), script, 'test.txt')
+    references = transpiler.collect_references()
+    assert references.backgrounds == {'12'}
+    assert references.cgs == {'3', '4'}
+    assert references.sprites == {('m4a1', 2), ('g36cmod', 0)}
+    assert references.audio == {'BGM_Theme', 'SE_Door'}
+
+
+def test_trimmed_sprite():
+    resources = stories.StoryResources.empty()
+    resources.characters = {'m4a1': {
+        '0': mapper.SpriteDetails('m4a1/0.png', 0.8, (0, 0), (40, 30), crop=(10, 20, 90, 100), canvas=(100, 100)),
+        '1': mapper.SpriteDetails('m4a1/1.png', -1, (0, 0)),
+    }}
+    transpiler = stories.StoryTranspiler(resources, '', 'test.txt')
+    # the geometry of trimmed sprites comes from characters.json as it is
+    trimmed = transpiler._get_sprite_info('M4A1', 0)
+    assert trimmed['scale'] == 0.8
+    assert trimmed['center'] == [40, 30]
+    untrimmed = transpiler._get_sprite_info('M4A1', 1)
+    assert untrimmed['scale'] == -1
+    assert untrimmed['center'] == (-1, -1)
+
+
+def test_load(tmp_path):
+    tmp_path.joinpath('stories.json').write_text(json.dumps({'1-1.txt': '1-1.txt'}))
+    ss = stories.Stories.load(str(tmp_path), str(tmp_path.joinpath('gf-data-ch')))
+    assert ss.extracted == {'1-1.txt': tmp_path.resolve().joinpath('1-1.txt')}
+
+
 if __name__ == '__main__':
     test_stories()
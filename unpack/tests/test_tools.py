@@ -0,0 +1,32 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+from gfunpack import tools
+
+
+def test_tool_runner():
+    runner = tools.ToolRunner(limit=4)
+    futures = [
+        runner.submit([sys.executable, '-c', f'print({i})'], 'audio', stdout=subprocess.PIPE, text=True)
+        for i in range(8)
+    ]
+    assert [f.result().stdout.strip() for f in futures] == [str(i) for i in range(8)]
+    failed = runner.run([sys.executable, '-c', 'import sys; sys.exit("broken")'], 'audio')
+    assert failed.returncode == 1 and 'broken' in failed.stderr
+    with pytest.raises(subprocess.TimeoutExpired):
+        runner.run([sys.executable, '-c', 'import time; time.sleep(10)'], 'audio', timeout=0.2)
+    assert len(runner.timings) == 10
+
+
+def test_cancel():
+    runner = tools.ToolRunner(limit=1)
+    start = time.perf_counter()
+    future = runner.submit([sys.executable, '-c', 'import time; time.sleep(10)'], 'audio')
+    time.sleep(0.2)
+    assert runner.cancel() == 1
+    assert future.cancelled()
+    assert runner.run([sys.executable, '-c', 'pass'], 'audio').returncode == 0
+    assert time.perf_counter() - start < 5
@@ -0,0 +1,29 @@
+import json
+import threading
+
+from gfunpack import trace
+
+
+def _work():
+    with trace.span('python', 'subprocess'):
+        pass
+
+
+def test_trace(tmp_path):
+    trace.enable(tmp_path.joinpath('trace.json'))
+    with trace.span('stage', 'stage'):
+        thread = threading.Thread(target=_work)
+        thread.start()
+        thread.join()
+    events = json.loads(trace.save().read_text())['traceEvents']
+    trace._tracer = None
+    spans = [e for e in events if e['ph'] == 'X']
+    assert [e['name'] for e in spans] == ['python', 'stage']
+    assert spans[0]['tid'] != spans[1]['tid']
+
+
+if __name__ == '__main__':
+    import pathlib
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        test_trace(pathlib.Path(d))